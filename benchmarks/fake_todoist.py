@@ -0,0 +1,545 @@
+import argparse
+from collections import Counter
+import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qsl, urlsplit
+
+
+# a stand-in for the parts of the todoist rest and sync apis todoist.Api uses,
+# kept in memory; point the app at it with TODOIST_BASE_URL
+
+
+EPOCH = datetime.datetime(2024, 1, 1)
+ITEM_NOT_FOUND = {
+    "error_code": 22,
+    "error": "Item not found",
+    "error_tag": "ITEM_NOT_FOUND",
+}
+
+
+def rest_due(due):
+    if not due:
+        return None
+    return {
+        "date": due.get("date"),
+        "is_recurring": due.get("is_recurring", False),
+        "string": due.get("string", due.get("date")),
+        "datetime": None,
+        "timezone": due.get("timezone"),
+    }
+
+
+class User:
+    def __init__(self, user_id, token):
+        self.id = user_id
+        self.token = token
+        # resource type -> id -> object, in sync api format
+        self.resources = {"items": {}, "notes": {}, "projects": {}, "sections": {}}
+        # (resource type, id) -> version of its last change
+        self.versions = {}
+
+
+class FakeTodoist:
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, retry_after=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.users = {}
+        self.version = 0
+        self.ids = itertools.count(1000000)
+        self.calls = Counter()
+        self.commands = Counter()
+        # endpoint -> status codes answered to its next calls, sync requests
+        # carrying commands are "POST /sync/v9/sync commands"
+        self.failures = {}
+
+    def new_id(self):
+        return str(next(self.ids))
+
+    def _touch(self, user, resource_type, obj):
+        self.version += 1
+        if resource_type == "items":
+            # one second per change keeps the timestamps ordered like versions
+            updated_at = EPOCH + datetime.timedelta(seconds=self.version)
+            obj["updated_at"] = f"{updated_at:%Y-%m-%dT%H:%M:%S}.000000Z"
+        user.resources[resource_type][obj["id"]] = obj
+        user.versions[(resource_type, obj["id"])] = self.version
+
+    # n users with a project of m tasks each, every task linked to a copy in a
+    # second project which also has a snooze section
+    def seed(self, users, tasks):
+        seeds = []
+        with self.lock:
+            for n in range(users):
+                user_id = 1000 + n
+                user = User(user_id, f"bench-token-{user_id}")
+                self.users[user.token] = user
+                projects = []
+                for name in ["Source", "Target"]:
+                    project = {
+                        "id": self.new_id(),
+                        "name": f"{name} {user_id}",
+                        "child_order": len(projects),
+                        "parent_id": None,
+                        "is_archived": False,
+                        "is_deleted": False,
+                    }
+                    self._touch(user, "projects", project)
+                    projects.append(project)
+                section = {
+                    "id": self.new_id(),
+                    "name": "Snoozed",
+                    "project_id": projects[0]["id"],
+                    "section_order": 1,
+                    "is_archived": False,
+                    "is_deleted": False,
+                }
+                self._touch(user, "sections", section)
+                links = []
+                for i in range(tasks):
+                    pair = []
+                    for project, label in [
+                        (projects[0], "redoist:source"),
+                        (projects[1], "redoist:destination"),
+                    ]:
+                        item = self._new_item(
+                            {
+                                "project_id": project["id"],
+                                "content": f"Task {i}",
+                                "labels": [label],
+                                "child_order": i,
+                            }
+                        )
+                        self._touch(user, "items", item)
+                        pair.append(item["id"])
+                    links.append(tuple(pair))
+                seeds.append(
+                    {
+                        "user_id": user_id,
+                        "token": user.token,
+                        "project_id": projects[0]["id"],
+                        "section_id": section["id"],
+                        "links": links,
+                        "sync_token": str(self.version),
+                    }
+                )
+        return seeds
+
+    def _new_item(self, args):
+        return {
+            "id": self.new_id(),
+            "project_id": args.get("project_id"),
+            "section_id": args.get("section_id"),
+            "parent_id": args.get("parent_id"),
+            "content": args.get("content", ""),
+            "description": args.get("description", ""),
+            "priority": args.get("priority", 1),
+            "labels": list(args.get("labels") or []),
+            "due": args.get("due"),
+            "checked": False,
+            "is_deleted": False,
+            "child_order": args.get("child_order", 0),
+            "added_at": "2024-01-01T00:00:00Z",
+        }
+
+    # change a task as the user would, returns the item for a webhook payload
+    def edit_item(self, token, item_id, **fields):
+        with self.lock:
+            user = self.users[token]
+            item = dict(user.resources["items"][item_id], **fields)
+            self._touch(user, "items", item)
+            return dict(item)
+
+    # answer the next times calls to the endpoint with the status, once
+    # after calls went through
+    def fail(self, endpoint, status=500, times=1, after=0):
+        with self.lock:
+            statuses = self.failures.setdefault(endpoint, [])
+            statuses.extend([None] * after + [status] * times)
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def stats(self):
+        with self.lock:
+            return {
+                "calls": dict(self.calls),
+                "commands": dict(self.commands),
+                "total_calls": sum(self.calls.values()),
+            }
+
+    # sync api
+
+    def sync(self, user, data):
+        response = {}
+        commands = data.get("commands")
+        if commands:
+            response.update(self.run_commands(user, commands))
+        resource_types = data.get("resource_types")
+        if resource_types:
+            if "all" in resource_types:
+                resource_types = list(user.resources)
+            sync_token = data.get("sync_token") or "*"
+            since = 0 if sync_token == "*" else int(sync_token)
+            for resource_type in resource_types:
+                if resource_type not in user.resources:
+                    continue
+                response[resource_type] = [
+                    dict(obj)
+                    for obj_id, obj in user.resources[resource_type].items()
+                    if user.versions[(resource_type, obj_id)] > since
+                    and not (since == 0 and obj.get("is_deleted"))
+                ]
+            response["full_sync"] = since == 0
+        response["sync_token"] = str(self.version)
+        return response
+
+    def run_commands(self, user, commands):
+        sync_status = {}
+        temp_id_mapping = {}
+        items = user.resources["items"]
+        notes = user.resources["notes"]
+        for command in commands:
+            self.commands[command["type"]] += 1
+            args = {
+                key: temp_id_mapping.get(value, value)
+                if isinstance(value, str)
+                else value
+                for key, value in command.get("args", {}).items()
+            }
+            command_type = command["type"]
+            status = "ok"
+            if command_type == "item_add":
+                item = self._new_item(args)
+                temp_id_mapping[command["temp_id"]] = item["id"]
+                self._touch(user, "items", item)
+            elif command_type == "note_add":
+                if args.get("item_id") not in items:
+                    status = ITEM_NOT_FOUND
+                else:
+                    note = {
+                        "id": self.new_id(),
+                        "item_id": args["item_id"],
+                        "content": args.get("content", ""),
+                        "file_attachment": args.get("file_attachment"),
+                        "is_deleted": False,
+                        "posted_at": "2024-01-01T00:00:00Z",
+                    }
+                    temp_id_mapping[command["temp_id"]] = note["id"]
+                    self._touch(user, "notes", note)
+            elif command_type.startswith("item_") or command_type.startswith("note_"):
+                resource_type = "items" if command_type.startswith("item_") else "notes"
+                resources = items if resource_type == "items" else notes
+                obj = resources.get(args.get("id"))
+                if obj is None or obj.get("is_deleted"):
+                    status = ITEM_NOT_FOUND
+                else:
+                    obj = dict(obj)
+                    fields = {k: v for k, v in args.items() if k != "id"}
+                    if command_type in ("item_update", "note_update"):
+                        obj.update(fields)
+                    elif command_type == "item_move":
+                        obj.update(fields)
+                        if "parent_id" not in fields:
+                            obj["parent_id"] = None
+                        if "project_id" in fields:
+                            # moved to the root of the project
+                            obj["section_id"] = None
+                    elif command_type == "item_close":
+                        obj["checked"] = True
+                    elif command_type in ("item_delete", "note_delete"):
+                        obj["is_deleted"] = True
+                    else:
+                        status = {"error_code": 15, "error": "Invalid command"}
+                    if status == "ok":
+                        self._touch(user, resource_type, obj)
+            else:
+                status = {"error_code": 15, "error": "Invalid command"}
+            sync_status[command["uuid"]] = status
+        return {"sync_status": sync_status, "temp_id_mapping": temp_id_mapping}
+
+    # rest api
+
+    def rest_task(self, item):
+        return {
+            "id": item["id"],
+            "assignee_id": None,
+            "assigner_id": None,
+            "comment_count": 0,
+            "is_completed": item["checked"],
+            "content": item["content"],
+            "created_at": item["added_at"],
+            "creator_id": "0",
+            "description": item["description"],
+            "due": rest_due(item["due"]),
+            "labels": item["labels"],
+            "order": item["child_order"],
+            "parent_id": item["parent_id"],
+            "priority": item["priority"],
+            "project_id": item["project_id"],
+            "section_id": item["section_id"],
+            "url": f"https://todoist.com/showTask?id={item['id']}",
+            "duration": None,
+        }
+
+    def rest_task_args(self, data):
+        args = {
+            key: data[key]
+            for key in [
+                "content",
+                "description",
+                "project_id",
+                "section_id",
+                "parent_id",
+                "labels",
+                "priority",
+            ]
+            if key in data
+        }
+        if "order" in data:
+            args["child_order"] = data["order"]
+        for key in ["due_string", "due_date", "due_datetime"]:
+            if data.get(key):
+                args["due"] = {"date": data[key], "string": data[key]}
+        return args
+
+    def rest(self, user, method, path, data):
+        items = user.resources["items"]
+        if path == "/rest/v2/tasks":
+            if method == "GET":
+                return [
+                    self.rest_task(item)
+                    for item in items.values()
+                    if not item["checked"]
+                    and not item["is_deleted"]
+                    and all(
+                        item.get(key) == data[key]
+                        for key in ["project_id", "section_id"]
+                        if key in data
+                    )
+                    and ("ids" not in data or item["id"] in data["ids"].split(","))
+                ]
+            item = self._new_item(self.rest_task_args(data))
+            self._touch(user, "items", item)
+            return self.rest_task(item)
+        match = re.fullmatch(r"/rest/v2/tasks/(\w+)(/close|/reopen)?", path)
+        if match:
+            item = items.get(match.group(1))
+            if item is None or item["is_deleted"]:
+                return 404
+            if method == "GET":
+                return self.rest_task(item)
+            item = dict(item)
+            if method == "DELETE":
+                item["is_deleted"] = True
+            elif match.group(2):
+                item["checked"] = match.group(2) == "/close"
+            else:
+                item.update(self.rest_task_args(data))
+            self._touch(user, "items", item)
+            return 204 if method == "DELETE" or match.group(2) else self.rest_task(item)
+        if path == "/rest/v2/comments":
+            if method == "GET":
+                return [
+                    {
+                        "id": note["id"],
+                        "task_id": note["item_id"],
+                        "project_id": None,
+                        "content": note["content"],
+                        "posted_at": note["posted_at"],
+                        "attachment": note["file_attachment"],
+                    }
+                    for note in user.resources["notes"].values()
+                    if note["item_id"] == data.get("task_id")
+                    and not note["is_deleted"]
+                ]
+            result = self.run_commands(
+                user,
+                [
+                    {
+                        "type": "note_add",
+                        "uuid": "rest",
+                        "temp_id": "rest",
+                        "args": {
+                            "item_id": data.get("task_id"),
+                            "content": data.get("content", ""),
+                        },
+                    }
+                ],
+            )
+            if result["sync_status"]["rest"] != "ok":
+                return 404
+            note = user.resources["notes"][result["temp_id_mapping"]["rest"]]
+            return {
+                "id": note["id"],
+                "task_id": note["item_id"],
+                "project_id": None,
+                "content": note["content"],
+                "posted_at": note["posted_at"],
+                "attachment": None,
+            }
+        if path == "/rest/v2/projects" and method == "GET":
+            return [
+                {
+                    "id": project["id"],
+                    "name": project["name"],
+                    "color": "charcoal",
+                    "comment_count": 0,
+                    "is_favorite": False,
+                    "is_inbox_project": False,
+                    "is_shared": False,
+                    "is_team_inbox": False,
+                    "order": project["child_order"],
+                    "parent_id": project["parent_id"],
+                    "url": f"https://todoist.com/showProject?id={project['id']}",
+                    "view_style": "list",
+                }
+                for project in user.resources["projects"].values()
+                if not project["is_deleted"] and not project["is_archived"]
+            ]
+        if path == "/rest/v2/sections" and method == "GET":
+            return [
+                {
+                    "id": section["id"],
+                    "name": section["name"],
+                    "order": section["section_order"],
+                    "project_id": section["project_id"],
+                }
+                for section in user.resources["sections"].values()
+                if not section["is_deleted"]
+                and data.get("project_id") in (None, section["project_id"])
+            ]
+        return 404
+
+    def handle(self, method, path, token, data):
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+        endpoint = re.sub(r"/tasks/\w+", "/tasks/{id}", path)
+        with self.lock:
+            self.calls[f"{method} {endpoint}"] += 1
+            if self.error_rate and random.random() < self.error_rate:
+                return 429, {"error": "Too many requests"}
+            key = f"{method} {endpoint}"
+            if data.get("commands"):
+                key += " commands"
+            if self.failures.get(key):
+                status = self.failures[key].pop(0)
+                if status is not None:
+                    return status, {"error": "Injected failure"}
+            user = self.users.get(token)
+            if user is None:
+                return 401, {"error": "Unauthorized"}
+            if path == "/sync/v9/sync":
+                return 200, self.sync(user, data)
+            if path == "/sync/v9/items/get":
+                item = user.resources["items"].get(data.get("item_id"))
+                if item is None or item["is_deleted"]:
+                    return 404, {"error": "Item not found"}
+                return 200, {"item": dict(item), "notes": []}
+            result = self.rest(user, method, path, data)
+            if isinstance(result, int):
+                return result, None
+            return 200, result
+
+
+# values the sync api gets as json strings
+JSON_FIELDS = {"commands", "resource_types", "labels", "due", "file_attachment"}
+
+
+def parse_data(handler, query):
+    data = dict(parse_qsl(query))
+    length = int(handler.headers.get("Content-Length") or 0)
+    if length:
+        body = handler.rfile.read(length).decode()
+        if handler.headers.get("Content-Type", "").startswith("application/json"):
+            data.update(json.loads(body) or {})
+        else:
+            data.update(parse_qsl(body))
+    for key in JSON_FIELDS & set(data):
+        if isinstance(data[key], str):
+            try:
+                data[key] = json.loads(data[key])
+            except ValueError:
+                pass
+    return data
+
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _handle(self):
+            url = urlsplit(self.path)
+            if url.path == "/_stats":
+                self._send(200, fake.stats())
+                return
+            data = parse_data(self, url.query)
+            authorization = self.headers.get("Authorization", "")
+            token = authorization.removeprefix("Bearer ")
+            status, body = fake.handle(self.command, url.path, token, data)
+            self._send(status, body)
+
+        def _send(self, status, body):
+            payload = b"" if body is None else json.dumps(body).encode()
+            self.send_response(status)
+            if status == 429:
+                self.send_header("Retry-After", str(fake.retry_after))
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        do_GET = do_POST = do_DELETE = _handle
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+# serve the fake in a background thread, returns the server and its base url
+def serve(fake, host="127.0.0.1", port=0):
+    server = ThreadingHTTPServer((host, port), make_handler(fake))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake Todoist API server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--tasks", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument(
+        "--seed-file", help="write the seeded users, tokens and links as json here"
+    )
+    args = parser.parse_args()
+    fake = FakeTodoist(args.latency, args.jitter, args.error_rate, args.retry_after)
+    seeds = fake.seed(args.users, args.tasks)
+    if args.seed_file:
+        with open(args.seed_file, "w") as f:
+            json.dump(seeds, f)
+    server, url = serve(fake, args.host, args.port)
+    print(f"Fake Todoist listening on {url}, set TODOIST_BASE_URL={url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
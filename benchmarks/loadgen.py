@@ -0,0 +1,243 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from fake_todoist import FakeTodoist, serve
+
+
+EXTENSIONS_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "extensions"
+)
+SCENARIOS = ["webhook", "redoist-ui", "snoozer-ui"]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, round(p / 100 * (len(values) - 1)))]
+
+
+def load_app(fake_url, database_uri, coalesce_window):
+    # the app reads its configuration at import time
+    if fake_url is not None:
+        os.environ["TODOIST_BASE_URL"] = fake_url
+    os.environ["SQLALCHEMY_DATABASE_URI"] = database_uri
+    os.environ["REDOIST_COALESCE_WINDOW"] = str(coalesce_window)
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    sys.path.insert(0, os.path.abspath(EXTENSIONS_DIR))
+    import app
+
+    return app
+
+
+def seed_app(app_module, seeds):
+    from models import (
+        db,
+        RedoistManifests,
+        RedoistUsers,
+        SnoozerMap,
+        SnoozerUsers,
+    )
+
+    with app_module.app.app_context():
+        for seed in seeds:
+            db.session.add(
+                RedoistUsers(
+                    id=seed["user_id"],
+                    api_key=seed["token"],
+                    sync_token=seed["sync_token"],
+                )
+            )
+            db.session.add(SnoozerUsers(id=seed["user_id"], api_key=seed["token"]))
+            db.session.add(
+                SnoozerMap(
+                    user_id=seed["user_id"],
+                    source_project_id=seed["project_id"],
+                    target_section_id=seed["section_id"],
+                )
+            )
+            db.session.add_all(
+                RedoistManifests(
+                    user_id=seed["user_id"], source_id=source_id, target_id=target_id
+                )
+                for source_id, target_id in seed["links"]
+            )
+        db.session.commit()
+
+
+def webhook_request(fake, seed, n):
+    source_id, _ = random.choice(seed["links"])
+    item = fake.edit_item(seed["token"], source_id, content=f"Edit {n}")
+    payload = {
+        "event_name": "item:updated",
+        "user_id": str(seed["user_id"]),
+        "event_data": item,
+    }
+    return "/redoist/update", payload, {}
+
+
+def redoist_ui_request(fake, seed, n):
+    source_id, _ = random.choice(seed["links"])
+    payload = {
+        "extensionType": "context-menu",
+        "action": {"actionType": "initial", "params": {"sourceId": source_id}},
+        "context": {"user": {"id": seed["user_id"]}},
+    }
+    return "/redoist/ui", payload, {"X-Todoist-Apptoken": seed["token"]}
+
+
+def snoozer_ui_request(fake, seed, n):
+    payload = {
+        "action": {"actionType": "initial"},
+        "context": {"user": {"id": seed["user_id"], "timezone": "UTC"}},
+    }
+    return "/snoozer/ui", payload, {}
+
+
+REQUESTS = {
+    "webhook": webhook_request,
+    "redoist-ui": redoist_ui_request,
+    "snoozer-ui": snoozer_ui_request,
+}
+
+
+# wait for the webhook workers to work through the queue
+def drain(app_module, timeout):
+    import webhook_queue
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with app_module.app.app_context():
+            depths = webhook_queue.depths()
+        if not depths.get("pending") and not depths.get("processing"):
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def run(app_module, fake, seeds, scenario, requests, concurrency, drain_timeout):
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    local = threading.local()
+    calls_before = fake.total_calls()
+
+    def send(n):
+        nonlocal errors
+        if not hasattr(local, "client"):
+            local.client = app_module.app.test_client()
+        path, payload, headers = REQUESTS[scenario](fake, random.choice(seeds), n)
+        start = time.perf_counter()
+        response = local.client.post(path, json=payload, headers=headers)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, range(requests)))
+    elapsed = time.perf_counter() - start
+    drained = True
+    if scenario == "webhook":
+        # webhooks are only acknowledged by the route, count until processed
+        drained = drain(app_module, drain_timeout)
+        elapsed = time.perf_counter() - start
+    calls = fake.total_calls() - calls_before
+    return {
+        "scenario": scenario,
+        "requests": requests,
+        "errors": errors,
+        "drained": drained,
+        "requests_per_s": requests / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "todoist_calls": calls,
+        "todoist_calls_per_request": calls / requests if requests else 0.0,
+    }
+
+
+def report(results):
+    # result key, column title, value format
+    columns = [
+        ("scenario", "scenario", "{:<12}"),
+        ("requests", "requests", "{:>9}"),
+        ("errors", "errors", "{:>7}"),
+        ("requests_per_s", "req/s", "{:>10.1f}"),
+        ("p50_ms", "p50 ms", "{:>9.2f}"),
+        ("p95_ms", "p95 ms", "{:>9.2f}"),
+        ("p99_ms", "p99 ms", "{:>9.2f}"),
+        ("todoist_calls_per_request", "todoist calls/req", "{:>18.2f}"),
+    ]
+    titles = [fmt.replace(".1f", "").replace(".2f", "") for _, _, fmt in columns]
+    print(" ".join(fmt.format(title) for fmt, (_, title, _) in zip(titles, columns)))
+    for result in results:
+        print(" ".join(fmt.format(result[key]) for key, _, fmt in columns))
+        if not result["drained"]:
+            print(f"  {result['scenario']}: webhook queue not drained in time")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Drive the app with synthetic webhook and UI extension "
+        "traffic against a fake Todoist."
+    )
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument(
+        "--tasks", type=int, default=100, help="linked tasks per user"
+    )
+    parser.add_argument("--requests", type=int, default=500, help="per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--scenario", choices=SCENARIOS, action="append")
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="todoist latency in seconds"
+    )
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of 429s")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--coalesce-window", type=float, default=0.0)
+    parser.add_argument("--drain-timeout", type=float, default=120.0)
+    parser.add_argument(
+        "--database", help="SQLAlchemy URI, defaults to a fresh sqlite database"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix="tool-extensions-bench-")
+    # the app writes its logs relative to the working directory
+    os.chdir(workdir)
+    fake = FakeTodoist(args.latency, args.jitter, args.error_rate, args.retry_after)
+    seeds = fake.seed(args.users, args.tasks)
+    server, fake_url = serve(fake)
+    database_uri = args.database or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    app_module = load_app(fake_url, database_uri, args.coalesce_window)
+    seed_app(app_module, seeds)
+
+    results = [
+        run(
+            app_module,
+            fake,
+            seeds,
+            scenario,
+            args.requests,
+            args.concurrency,
+            args.drain_timeout,
+        )
+        for scenario in args.scenario or SCENARIOS
+    ]
+    report(results)
+    app_module.webhook_workers.stop()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+from loadgen import drain, load_app, percentile
+
+
+# replays a corpus written with RECORD_DIR against a copy of the database taken
+# when the recording started, answering todoist calls with the recorded
+# responses, and reports what the current build did with the same traffic
+
+
+def load_corpus(corpus_dir):
+    records = []
+    for path in glob.glob(os.path.join(corpus_dir, "*.jsonl.gz")):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    records.sort(key=lambda record: record["at"])
+    requests = [record for record in records if record["kind"] == "request"]
+    responses = [record for record in records if record["kind"] == "todoist"]
+    return requests, responses
+
+
+def replay_session(responses, latency):
+    import requests
+    import recorder
+
+    # recorded responses are served in order per token, endpoint and kind of
+    # call; once used up the last one is served again
+    class ReplaySession(requests.Session):
+        def __init__(self):
+            super().__init__()
+            self.queues = {}
+            self.last = {}
+            self.lock = threading.Lock()
+            self.served = 0
+            self.misses = 0
+            for record in responses:
+                self.queues.setdefault(self._key(record), deque()).append(record)
+
+        def _key(self, record):
+            return (
+                record["token"],
+                record["method"],
+                record["path"],
+                record["commands"] is not None,
+            )
+
+        def request(self, method, url, *args, **kwargs):
+            authorization = (kwargs.get("headers") or {}).get("Authorization", "")
+            token = recorder.alias(authorization.removeprefix("Bearer "))
+            commands = recorder.command_ids(kwargs)
+            key = (token, method, urlsplit(url).path, commands is not None)
+            with self.lock:
+                queue = self.queues.get(key)
+                record = queue.popleft() if queue else self.last.get(key)
+                if record is None:
+                    self.misses += 1
+                else:
+                    self.served += 1
+                    self.last[key] = record
+            response = requests.Response()
+            response.url = url
+            response.headers["Content-Type"] = "application/json"
+            if record is None:
+                response.status_code = 404
+                response.reason = "Not Recorded"
+                response._content = b'{"error": "not recorded"}'
+                return response
+            if latency:
+                time.sleep(record.get("elapsed") or 0)
+            body = record["body"]
+            if commands and record["commands"]:
+                body = remap_commands(body, record["commands"], commands)
+            response.status_code = record["status"]
+            response.reason = ""
+            if record.get("retry_after"):
+                response.headers["Retry-After"] = record["retry_after"]
+            response._content = body.encode()
+            return response
+
+    return ReplaySession()
+
+
+# the recorded per command results apply to the commands sent now by position
+def remap_commands(body, recorded, sent):
+    try:
+        result = json.loads(body)
+    except ValueError:
+        return body
+    sync_status = result.get("sync_status", {})
+    temp_id_mapping = result.get("temp_id_mapping", {})
+    result["sync_status"] = {}
+    result["temp_id_mapping"] = {}
+    for i, (command_uuid, temp_id) in enumerate(sent):
+        old_uuid, old_temp_id = recorded[i] if i < len(recorded) else (None, None)
+        result["sync_status"][command_uuid] = sync_status.get(old_uuid, "ok")
+        if temp_id is not None and old_temp_id in temp_id_mapping:
+            result["temp_id_mapping"][temp_id] = temp_id_mapping[old_temp_id]
+    return json.dumps(result)
+
+
+def replay(app_module, requests, speed, concurrency):
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    local = threading.local()
+
+    def send(record):
+        nonlocal errors
+        if not hasattr(local, "client"):
+            local.client = app_module.app.test_client()
+        headers = {}
+        if record["token"]:
+            headers["X-Todoist-Apptoken"] = record["token"]
+        start = time.perf_counter()
+        response = local.client.post(
+            record["path"], json=record["json"], headers=headers
+        )
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if response.status_code >= 400:
+                errors += 1
+
+    first = requests[0]["at"] if requests else 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for record in requests:
+            if speed:
+                wait = (record["at"] - first) / speed - (time.perf_counter() - start)
+                if wait > 0:
+                    time.sleep(wait)
+            executor.submit(send, record)
+    return latencies, errors, start
+
+
+def summarize(session, requests, latencies, errors, start, drained):
+    import metrics
+
+    by_method = {
+        labels[0]: count
+        for labels, (count, _) in metrics.todoist_calls.totals().items()
+    }
+    db_count, db_seconds = metrics.db_queries.totals().get((), (0, 0.0))
+    return {
+        "requests": len(requests),
+        "errors": errors,
+        "drained": drained,
+        "wall_s": time.perf_counter() - start,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "todoist_calls": sum(by_method.values()),
+        "todoist_calls_by_method": by_method,
+        "db_queries": db_count,
+        "db_seconds": db_seconds,
+        "replayed_responses": session.served,
+        "unrecorded_calls": session.misses,
+    }
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(f"{'metric':<20} {'before':>12} {'after':>12} {'change':>9}")
+    for key, value in before.items():
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            continue
+        new_value = after.get(key, 0)
+        change = f"{(new_value - value) / value * 100:+.1f}%" if value else "n/a"
+        print(f"{key:<20} {value:>12.2f} {new_value:>12.2f} {change:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay a recorded corpus against the current build, or "
+        "compare two replay summaries."
+    )
+    parser.add_argument("corpus", nargs="?", help="directory given as RECORD_DIR")
+    parser.add_argument(
+        "--database",
+        help="SQLAlchemy URI of a copy of the database taken when recording "
+        "started, it is modified by the replay",
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="1 replays at the original pace, 10 ten times faster, 0 at once",
+    )
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--latency", action="store_true", help="wait the recorded todoist latency"
+    )
+    parser.add_argument("--coalesce-window", type=float, default=0.0)
+    parser.add_argument("--drain-timeout", type=float, default=300.0)
+    parser.add_argument("--output", help="write the summary as json here")
+    parser.add_argument(
+        "--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="summary files"
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if not args.corpus or not args.database:
+        parser.error("a corpus and --database are required to replay")
+
+    requests, responses = load_corpus(args.corpus)
+    workdir = tempfile.mkdtemp(prefix="tool-extensions-replay-")
+    output = os.path.abspath(args.output) if args.output else None
+    # the app writes its logs relative to the working directory
+    os.chdir(workdir)
+    os.environ.pop("RECORD_DIR", None)
+    app_module = load_app(None, args.database, args.coalesce_window)
+    import todoist
+
+    # clients created from here on send their calls to the recording
+    session = replay_session(responses, args.latency)
+    todoist.session = session
+
+    latencies, errors, start = replay(
+        app_module, requests, args.speed, args.concurrency
+    )
+    drained = drain(app_module, args.drain_timeout)
+    summary = summarize(session, requests, latencies, errors, start, drained)
+    app_module.webhook_workers.stop()
+    print(json.dumps(summary, indent=2))
+    if output:
+        with open(output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,32 @@
 import datetime
 from dotenv import load_dotenv
-import json
+from functools import partial
 import logging
-from logging.handlers import RotatingFileHandler
 import os
 import time
 import uuid
 from zoneinfo import ZoneInfo
 
-from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
-from flask import Flask, redirect, render_template
+from flask import Flask, Response, g, redirect, render_template
 from flask import request
-from flask_apscheduler import APScheduler
-import requests
-from sqlalchemy import or_, and_
-
-from todoist import Api
+from sqlalchemy import and_, bindparam, or_
+from sqlalchemy.exc import IntegrityError
+
+import cards
+import catalog
+import leases
+import logs
+import metrics
+import ratelimit
+import recorder
+import snoozer
+import todoist
+from todoist import gather, gather_by_key, get_api
+import replica
+import webhook_queue
 from models import (
     db,
+    migrate,
     OauthState,
     RedoistUsers,
     RedoistManifests,
@@ -29,15 +38,12 @@ from models import (
 
 load_dotenv()
 app = Flask(__name__)
+# key order does not matter to todoist, skip sorting the cards returned as dicts
+app.json.sort_keys = False
 
 # logging
+log_listener = logs.setup()
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-os.makedirs("logs", exist_ok=True)
-handler = RotatingFileHandler("logs/app.log", maxBytes=1000000, backupCount=3)
-formatter = logging.Formatter("%(asctime)s %(levelname)s - \n%(message)s")
-handler.setFormatter(formatter)
-logger.addHandler(handler)
 
 # database
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ["SQLALCHEMY_DATABASE_URI"]
@@ -46,13 +52,108 @@ db.init_app(app)
 with app.app_context():
     engine_url = db.engine.url
     db.create_all()
+    migrate(db.engine)
+    metrics.instrument_engine(db.engine)
+
+
+# snoozes are kept in their own table and woken by a poller
+with app.app_context():
+    snoozer.migrate_jobs(engine_url)
+# leader: the poller runs in one process at a time, the others stand by
+# all: every process polls, claims still keep a snooze from waking twice
+# off: this process only schedules snoozes, e.g. web workers next to a
+# dedicated poller process
+snoozer_mode = os.environ.get("SNOOZER_MODE", "leader")
+snooze_poller = snoozer.SnoozePoller(
+    app,
+    batch_size=int(os.environ.get("SNOOZER_BATCH_SIZE", 500)),
+    poll_interval=float(os.environ.get("SNOOZER_POLL_INTERVAL", 1)),
+    max_attempts=int(os.environ.get("SNOOZER_MAX_ATTEMPTS", 5)),
+    leadership=(
+        leases.Lease(
+            "snooze-poller", ttl=float(os.environ.get("SNOOZER_LEADER_TTL", 10))
+        )
+        if snoozer_mode == "leader"
+        else None
+    ),
+)
+if snoozer_mode != "off":
+    snooze_poller.start()
+# "async" records a submitted snooze and leaves moving the task to the poller,
+# "sync" moves it before answering
+snoozer_submit = os.environ.get("SNOOZER_SUBMIT", "async")
+
+# interactive ui extension calls get ahead of background sync traffic
+INTERACTIVE_ROUTES = {"/redoist/ui", "/snoozer/ui", "/snoozer/settings"}
+
+
+@app.before_request
+def set_todoist_priority():
+    ratelimit.priority.set(
+        "interactive" if request.path in INTERACTIVE_ROUTES else "background"
+    )
+
+
+recorder.start()
+
+
+@app.before_request
+def record_request():
+    if recorder.active():
+        recorder.record_request(
+            request.path,
+            request.headers.get("X-Todoist-Apptoken"),
+            request.get_json(silent=True),
+        )
+
+
+@app.before_request
+def start_metrics():
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    g.metrics = (route, time.perf_counter(), *metrics.enter(route))
+
+
+@app.teardown_request
+def observe_metrics(exc):
+    if "metrics" not in g:
+        return
+    route, start, scope, reset = g.metrics
+    metrics.http_requests.observe(time.perf_counter() - start, route, request.method)
+    metrics.leave(scope, reset)
+
+
+metrics.gauge(
+    "webhook_queue_events",
+    "Queued redoist webhook events by status.",
+    lambda: {(status,): n for status, n in webhook_queue.depths().items()},
+    ("status",),
+)
+metrics.gauge(
+    "todoist_fanout_backlog",
+    "Calls waiting for a thread of todoist.gather.",
+    lambda: {(): todoist.fanout_backlog()},
+)
+metrics.gauge(
+    "snoozer_pending",
+    "Snoozed tasks waiting for their run time.",
+    lambda: {(): snoozer.pending()},
+)
+metrics.gauge(
+    "snoozer_leader",
+    "1 if this process runs the snooze poller.",
+    lambda: {(): int(snoozer_mode != "off" and snooze_poller.is_leader())},
+)
+metrics.gauge(
+    "log_queue_records",
+    "Log records waiting to be written.",
+    lambda: {(): log_listener.queue.qsize()},
+)
+
 
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
-# initialize scheduler
-app.config["SCHEDULER_JOBSTORES"] = {"default": SQLAlchemyJobStore(url=engine_url)}
-scheduler = APScheduler()
-scheduler.init_app(app)
-scheduler.start()
 
 ###
 # ROOT
@@ -79,82 +180,15 @@ def redoist():
 # endpoint for the todoist UI extension
 @app.route("/redoist/ui", methods=["GET", "POST"])
 def redoist_extension():
-    logger.debug(f"{request.method} {request.path}")
-    logger.debug(json.dumps(request.json, indent=2, sort_keys=True))
+    logs.request_payload(logger, request)
     token = request.headers.get("X-Todoist-Apptoken")
     if not token:
         return {"error": "No token provided."}, 400
-    api = Api(token)
+    api = get_api(token)
     if request.json["extensionType"] == "context-menu":
         if request.json["action"]["actionType"] == "initial":
-            # set some vars
             static_url = f"https://{request.host}/static"
             user_id = request.json["context"]["user"]["id"]
-            outbound_column = {
-                "type": "Column",
-                "spacing": "large",
-                "items": [
-                    {
-                        "type": "TextBlock",
-                        "text": "Outbound",
-                    },
-                    {
-                        "type": "Image",
-                        "url": f"{static_url}/outbound.png",
-                    },
-                ],
-            }
-            inbound_column = {
-                "type": "Column",
-                "spacing": "large",
-                "items": [
-                    {
-                        "type": "TextBlock",
-                        "text": "Inbound",
-                    },
-                    {
-                        "type": "Image",
-                        "url": f"{static_url}/inbound.png",
-                    },
-                ],
-            }
-            bidirectional_column = {
-                "type": "Column",
-                "spacing": "large",
-                "items": [
-                    {
-                        "type": "TextBlock",
-                        "text": "Bidirectional",
-                    },
-                    {
-                        "type": "Image",
-                        "url": f"{static_url}/bidirectional.png",
-                    },
-                ],
-            }
-            unlink_column = {
-                "type": "Column",
-                "spacing": "large",
-                "items": [
-                    {
-                        "type": "TextBlock",
-                        "text": "Unlink",
-                    },
-                    {
-                        "type": "Image",
-                        "url": f"{static_url}/unlink.png",
-                    },
-                ],
-            }
-            modified_choice_set = {
-                "type": "Input.ChoiceSet",
-                "spacing": "large",
-                "label": "Change sync direction (red icon represents this task)",
-                "id": "inputDirection",
-                "choices": [],
-                # "style": "expanded",
-            }
-
             # look for card id in manifest
             card_id = request.json["action"]["params"]["sourceId"]
             manifest = db.session.scalars(
@@ -167,177 +201,53 @@ def redoist_extension():
             ).all()
             # if found, context menu should provide source and target ids
             if len(manifest) > 0:
-                # link exists
-                card = {
-                    "card": {
-                        "type": "AdaptiveCard",
-                        "body": [
-                            {
-                                "type": "TextBlock",
-                                "text": "This task is already linked to another.",
-                                "wrap": True,
-                            }
-                        ],
-                    }
-                }
-                # allow owner to modify direction or unlink
-                if manifest[0].user_id == user_id:
-                    card["card"]["body"].append(
-                        {
-                            "type": "ColumnSet",
-                            "spacing": "large",
-                            "columns": [],
-                        }
-                    )
-                    if len(manifest) > 1:
-                        # bidirectional, add outbound, inbound, unlink
-                        card["card"]["body"][-1]["columns"].extend(
-                            [
-                                outbound_column,
-                                inbound_column,
-                                unlink_column,
-                            ]
-                        )
-                        modified_choice_set["choices"].extend(
-                            [
-                                {"title": "Outbound", "value": "outbound"},
-                                {"title": "Inbound", "value": "inbound"},
-                                {"title": "Unlink", "value": "unlink"},
-                            ]
-                        )
-                    else:
-                        if manifest[0].source_id == card_id:
-                            # outbound, add inbound, bidirectional, unlink
-                            card["card"]["body"][-1]["columns"].extend(
-                                [
-                                    inbound_column,
-                                    bidirectional_column,
-                                    unlink_column,
-                                ]
-                            )
-                            modified_choice_set["choices"].extend(
-                                [
-                                    {"title": "Inbound", "value": "inbound"},
-                                    {
-                                        "title": "Bidirectional",
-                                        "value": "bidirectional",
-                                    },
-                                    {"title": "Unlink", "value": "unlink"},
-                                ]
-                            )
-                        else:
-                            # inbound, add outbound, bidirectional, unlink
-                            card["card"]["body"][-1]["columns"].extend(
-                                [
-                                    outbound_column,
-                                    bidirectional_column,
-                                    unlink_column,
-                                ]
-                            )
-                            modified_choice_set["choices"].extend(
-                                [
-                                    {"title": "Outbound", "value": "outbound"},
-                                    {
-                                        "title": "Bidirectional",
-                                        "value": "bidirectional",
-                                    },
-                                    {"title": "Unlink", "value": "unlink"},
-                                ]
-                            )
-                    card["card"]["body"].extend(
-                        [
-                            {
-                                "type": "TextBlock",
-                                "spacing": "large",
-                                "text": " ",
-                            },
-                            modified_choice_set,
-                        ]
-                    )
-                    card["card"]["actions"] = [
-                        {
-                            "type": "Action.Submit",
-                            "title": "Submit",
-                            "style": "positive",
-                            "associatedInputs": "auto",
-                        },
-                    ]
+                # link exists, allow owner to modify direction or unlink
+                if len(manifest) > 1:
+                    direction = "bidirectional"
+                elif manifest[0].source_id == card_id:
+                    direction = "outbound"
                 else:
-                    card["card"]["body"].append(
-                        {
-                            "type": "TextBlock",
-                            "text": "You did not create the link and cannot modify it. Contact the owner to make changes.",
-                            "wrap": True,
-                        }
-                    )
+                    direction = "inbound"
+                card = cards.redoist_linked(
+                    static_url, direction, manifest[0].user_id == user_id
+                )
             else:
                 # if not found, context menu should provide option to create a new linked task
-                projects = api.get_projects()
-                prj_map = [{"title": prj.name, "value": prj.id} for prj in projects]
-                card = {
-                    "card": {
-                        "type": "AdaptiveCard",
-                        "body": [
-                            {
-                                "type": "TextBlock",
-                                "text": "Choose the project to create the linked task in.",
-                                "wrap": True,
-                            },
-                            {
-                                "type": "Input.ChoiceSet",
-                                "label": "Project",
-                                "id": "inputProject",
-                                "choices": prj_map,
-                            },
-                            {
-                                "type": "TextBlock",
-                                "spacing": "large",
-                                "text": " ",
-                            },
-                            {
-                                "type": "ColumnSet",
-                                "spacing": "large",
-                                "columns": [
-                                    outbound_column,
-                                    inbound_column,
-                                    bidirectional_column,
-                                ],
-                            },
-                            {
-                                "type": "TextBlock",
-                                "spacing": "large",
-                                "text": " ",
-                            },
-                            {
-                                "type": "Input.ChoiceSet",
-                                "spacing": "large",
-                                "label": "Change sync direction (red icon represents this task)",
-                                "id": "inputDirection",
-                                "choices": [
-                                    {"title": "Outbound", "value": "outbound"},
-                                    {"title": "Inbound", "value": "inbound"},
-                                    {
-                                        "title": "Bidirectional",
-                                        "value": "bidirectional",
-                                    },
-                                ],
-                                # "style": "expanded",
-                            },
-                        ],
-                        "actions": [
-                            {
-                                "type": "Action.Submit",
-                                "title": "Submit",
-                                "style": "positive",
-                                "associatedInputs": "auto",
-                            },
-                        ],
-                    }
-                }
-            return card
+                projects = catalog.get_projects(api)
+                prj_map = [
+                    {"title": prj["name"], "value": prj["id"]} for prj in projects
+                ]
+                card = cards.redoist_new(
+                    static_url,
+                    prj_map,
+                    request.json["action"]["params"].get("source") == "project",
+                )
+            return cards.response(card)
         if request.json["action"]["actionType"] == "submit":
             # create or modify link
-            if "inputProject" in request.json["action"]["inputs"]:
+            inputs = request.json["action"]["inputs"]
+            if request.json["action"]["params"].get("source") == "project":
+                scope = "project"
+            else:
+                scope = inputs.get("inputScope", "task")
+            if "inputProject" in inputs and scope != "task":
+                # clone and link a whole project or subtree
+                source_id = request.json["action"]["params"]["sourceId"]
+                if scope == "project":
+                    tasks = task_hierarchy(api.get_tasks(project_id=source_id))
+                else:
+                    orig_task = api.get_task(source_id)
+                    tasks = task_hierarchy(
+                        api.get_tasks(project_id=orig_task.project_id), source_id
+                    )
+                link_hierarchy(
+                    api,
+                    request.json["context"]["user"]["id"],
+                    tasks,
+                    inputs["inputProject"],
+                    inputs["inputDirection"],
+                )
+            elif "inputProject" in inputs:
                 # create task and link
                 # create
                 orig_task = api.get_task(request.json["action"]["params"]["sourceId"])
@@ -389,13 +299,17 @@ def redoist_extension():
                     db.session.add(manifest)
                     db.session.commit()
                     # add redoist:bidirectional label to both tasks
-                    api.update_task(
-                        orig_task.id,
-                        labels=[*orig_task.labels, "redoist:bidirectional"],
-                    )
-                    api.update_task(
-                        new_task.id,
-                        labels=[*new_task.labels, "redoist:bidirectional"],
+                    gather(
+                        partial(
+                            api.update_task,
+                            orig_task.id,
+                            labels=[*orig_task.labels, "redoist:bidirectional"],
+                        ),
+                        partial(
+                            api.update_task,
+                            new_task.id,
+                            labels=[*new_task.labels, "redoist:bidirectional"],
+                        ),
                     )
                 else:
                     # create one manifest
@@ -407,13 +321,17 @@ def redoist_extension():
                     db.session.add(manifest)
                     db.session.commit()
                     # add redoist:source|destination label to each task
-                    api.update_task(
-                        source_id,
-                        labels=[*orig_task.labels, "redoist:source"],
-                    )
-                    api.update_task(
-                        target_id,
-                        labels=[*new_task.labels, "redoist:destination"],
+                    gather(
+                        partial(
+                            api.update_task,
+                            source_id,
+                            labels=[*orig_task.labels, "redoist:source"],
+                        ),
+                        partial(
+                            api.update_task,
+                            target_id,
+                            labels=[*new_task.labels, "redoist:destination"],
+                        ),
                     )
             else:
                 # modify link only
@@ -435,8 +353,10 @@ def redoist_extension():
                     if manifest.target_id == this_id:
                         that_id = manifest.source_id
                         break
-                this_card = api.get_task(this_id)
-                that_card = api.get_task(that_id)
+                this_card, that_card = gather(
+                    partial(api.get_task, this_id),
+                    partial(api.get_task, that_id),
+                )
                 direction = request.json["action"]["inputs"]["inputDirection"]
                 if direction == "unlink":
                     # remove old manifest(s)
@@ -453,11 +373,25 @@ def redoist_extension():
                     for label in this_card.labels:
                         if "redoist:" in label:
                             this_card.labels.remove(label)
-                    api.update_task(this_id, labels=this_card.labels)
                     for label in that_card.labels:
                         if "redoist:" in label:
                             that_card.labels.remove(label)
-                    api.update_task(that_id, labels=that_card.labels)
+                    gather_by_key(
+                        [
+                            (
+                                this_id,
+                                partial(
+                                    api.update_task, this_id, labels=this_card.labels
+                                ),
+                            ),
+                            (
+                                that_id,
+                                partial(
+                                    api.update_task, that_id, labels=that_card.labels
+                                ),
+                            ),
+                        ]
+                    )
                 elif direction == "outbound":
                     # remove old manifest(s)
                     db.session.execute(
@@ -474,12 +408,26 @@ def redoist_extension():
                         if "redoist:" in label:
                             this_card.labels.remove(label)
                     this_card.labels.append("redoist:source")
-                    api.update_task(this_id, labels=this_card.labels)
                     for label in that_card.labels:
                         if "redoist:" in label:
                             that_card.labels.remove(label)
                     that_card.labels.append("redoist:destination")
-                    api.update_task(that_id, labels=that_card.labels)
+                    gather_by_key(
+                        [
+                            (
+                                this_id,
+                                partial(
+                                    api.update_task, this_id, labels=this_card.labels
+                                ),
+                            ),
+                            (
+                                that_id,
+                                partial(
+                                    api.update_task, that_id, labels=that_card.labels
+                                ),
+                            ),
+                        ]
+                    )
                     # create new manifest
                     manifest = RedoistManifests(
                         user_id=user_id, source_id=this_id, target_id=that_id
@@ -502,12 +450,26 @@ def redoist_extension():
                         if "redoist:" in label:
                             this_card.labels.remove(label)
                     this_card.labels.append("redoist:destination")
-                    api.update_task(this_id, labels=this_card.labels)
                     for label in that_card.labels:
                         if "redoist:" in label:
                             that_card.labels.remove(label)
                     that_card.labels.append("redoist:source")
-                    api.update_task(that_id, labels=that_card.labels)
+                    gather_by_key(
+                        [
+                            (
+                                this_id,
+                                partial(
+                                    api.update_task, this_id, labels=this_card.labels
+                                ),
+                            ),
+                            (
+                                that_id,
+                                partial(
+                                    api.update_task, that_id, labels=that_card.labels
+                                ),
+                            ),
+                        ]
+                    )
                     # create new manifest
                     manifest = RedoistManifests(
                         user_id=user_id, source_id=that_id, target_id=this_id
@@ -530,12 +492,26 @@ def redoist_extension():
                         if "redoist:" in label:
                             this_card.labels.remove(label)
                     this_card.labels.append("redoist:bidirectional")
-                    api.update_task(this_id, labels=this_card.labels)
                     for label in that_card.labels:
                         if "redoist:" in label:
                             that_card.labels.remove(label)
                     that_card.labels.append("redoist:bidirectional")
-                    api.update_task(that_id, labels=that_card.labels)
+                    gather_by_key(
+                        [
+                            (
+                                this_id,
+                                partial(
+                                    api.update_task, this_id, labels=this_card.labels
+                                ),
+                            ),
+                            (
+                                that_id,
+                                partial(
+                                    api.update_task, that_id, labels=that_card.labels
+                                ),
+                            ),
+                        ]
+                    )
                     # create new manifest(s)
                     manifest = RedoistManifests(
                         user_id=user_id, source_id=this_id, target_id=that_id
@@ -553,101 +529,194 @@ def redoist_extension():
 # endpoint for the redoist webhook that updates cloned tasks
 @app.route("/redoist/update", methods=["POST"])
 def redoist_update():
-    logger.debug(f"{request.method} {request.path}")
-    logger.debug(json.dumps(request.json, indent=2, sort_keys=True))
-    user_id = int(request.json["user_id"])
+    logs.request_payload(logger, request)
+    # acknowledge right away, the webhook workers do the actual syncing
+    webhook_queue.enqueue(
+        int(request.json["user_id"]),
+        request.json,
+        delay=float(os.environ.get("REDOIST_COALESCE_WINDOW", 2)),
+    )
+    return ""
+
+
+# webhook events whose event_data is enough to run the diff without a sync
+WEBHOOK_FAST_PATH_EVENTS = {
+    "item:updated",
+    "item:completed",
+    "item:deleted",
+    "note:added",
+}
+
+
+@app.route("/redoist/stats")
+def redoist_stats():
+    return {
+        **webhook_workers.stats(),
+        "todoist": todoist.pool_stats(),
+        "catalog": catalog.stats,
+        "rate_limits": ratelimit.bucket_stats(),
+    }
+
+
+# one sync and diff pass for all coalesced webhooks of a user
+def process_redoist_update(payloads):
+    user_id = int(payloads[0]["user_id"])
     user = db.session.execute(
         db.select(RedoistUsers).where(RedoistUsers.id == user_id)
     ).scalar_one_or_none()
     if user is None:
         return ""
-    api = Api(user.api_key)
+    api = get_api(user.api_key)
     resource_types = '["items", "notes"]'
-    sync = api.sync(resource_types, sync_token=user.sync_token)
-    user.sync_token = sync["sync_token"]
-    db.session.add(user)
-    db.session.commit()
+    replica_ready = user.sync_token not in (None, "*") and replica.is_ready(user_id)
+    sync = webhook_sync(user_id, payloads) if replica_ready else None
+    # only stored once the writes of this pass went out, a failed pass is
+    # retried from the old token
+    new_sync_token = None
+    if sync is not None:
+        # the webhooks carry everything the diff needs, the sync token is
+        # left alone so the next incremental sync sees these changes again,
+        # which the digests make harmless
+        webhook_queue.count("fast_path")
+        replica.apply_sync(user_id, sync)
+    else:
+        if user.sync_token not in (None, "*") and not replica_ready:
+            # build the replica with a full sync, the diff below still only
+            # looks at what changed since the stored sync token
+            replica.apply_sync(user_id, api.sync(resource_types))
+        sync = api.sync(resource_types, sync_token=user.sync_token)
+        replica.apply_sync(user_id, sync)
+        new_sync_token = sync["sync_token"]
+    # resolve every link the diff can touch up front, in a few IN queries
+    source_ids = {source_item["id"] for source_item in sync["items"]}
+    source_ids.update(
+        source_item["parent_id"]
+        for source_item in sync["items"]
+        if source_item.get("parent_id")
+    )
+    source_ids.update(source_note["item_id"] for source_note in sync["notes"])
+    links, synced_digests = load_links(source_ids)
+    mirrors, _ = load_links(links.values())
+    note_id_maps, note_digests = load_note_id_maps(
+        source_note["id"] for source_note in sync["notes"]
+    )
+    targets = replica.get_items(
+        user_id,
+        (
+            links[source_item["id"]]
+            for source_item in sync["items"]
+            if source_item["id"] in links
+        ),
+    )
+    targets.update(
+        replica.fetch_items(
+            api,
+            user_id,
+            [
+                links[source_item["id"]]
+                for source_item in sync["items"]
+                if source_item["id"] in links
+                and links[source_item["id"]] not in targets
+                and not source_item["is_deleted"]
+                and not source_item["checked"]
+            ],
+        )
+    )
+    # every map and digest change below waits for the uuid of the command it
+    # depends on, or None, and is written in bulk once todoist accepted it
+    # link source -> uuid of the delete or close of its target
+    unlinked = {}
+    # link source -> (uuid of the item_update sent for it, new synced digest)
+    new_synced_digests = {}
+    # source note -> uuid of the delete of its target note
+    deleted_notes = {}
+    deleted_mirror_notes = {}
+    # note map source -> (uuid of the note_update, new digest)
+    new_note_digests = {}
+    # every write below is queued and sent in as few sync requests as
+    # possible, none before the diff is complete
+    batch = api.batch(deferred=True)
+    # note maps for added notes can only be written once the batch is flushed
+    added_notes = []
     for source_item in sync["items"]:
         source_id = source_item["id"]
-        manifest = db.session.scalars(
-            db.select(RedoistManifests).where(RedoistManifests.source_id == source_id)
-        ).one_or_none()
-        if manifest is None:
+        target_id = links.get(source_id)
+        if target_id is None:
             continue
-        mirror = db.session.scalars(
-            db.select(RedoistManifests).where(
-                RedoistManifests.source_id == manifest.target_id,
-                RedoistManifests.target_id == source_id,
-            )
-        ).one_or_none()
-        is_bidirectional = True if mirror is not None else False
-        target_id = manifest.target_id
-        if source_item["is_deleted"]:
-            # delete target
-            api.delete_task(target_id)
-            # remove manifests
-            db.session.execute(
-                db.delete(RedoistManifests).where(
-                    or_(
-                        RedoistManifests.source_id == source_id,
-                        RedoistManifests.target_id == source_id,
-                    )
-                )
-            )
-            db.session.commit()
-            continue
-        if source_item["checked"]:
-            # complete target
-            api.close_task(target_id)
+        is_bidirectional = mirrors.get(target_id) == source_id
+        if source_item["is_deleted"] or source_item["checked"]:
+            if source_item["is_deleted"]:
+                # delete target
+                command_uuid = batch.item_delete(target_id)
+            else:
+                # complete target
+                command_uuid = batch.item_close(target_id)
             # remove manifests
-            db.session.execute(
-                db.delete(RedoistManifests).where(
-                    or_(
-                        RedoistManifests.source_id == source_id,
-                        RedoistManifests.target_id == source_id,
-                    )
-                )
-            )
-            db.session.commit()
+            unlinked[source_id] = command_uuid
+            del links[source_id]
+            if links.get(target_id) == source_id:
+                del links[target_id]
             continue
 
-        # check for diff before updating
-        orig_target = api.get_task(target_id)
-        orig_target_dict = orig_target.to_dict()
+        # check for diff before updating, against the replica
+        orig_target_dict = targets.get(target_id)
+        if orig_target_dict is None:
+            continue
         true_source_labels = sorted(
             [label for label in source_item["labels"] if "redoist:" not in label]
         )
-        true_target_labels = sorted(
-            [label for label in orig_target_dict["labels"] if "redoist:" not in label]
-        )
-        new_target_kwargs = {}
-        for kw in [
-            "content",
-            "description",
-            "priority",
-            "parent_id",
-        ]:
-            if source_item.get(kw) != orig_target_dict.get(kw):
-                new_target_kwargs[kw] = source_item.get(kw)
-        if true_source_labels != true_target_labels:
-            # change in true labels, trigger task update
-            complete_target_labels = true_source_labels.copy()
-            target_redoist_label = (
-                "redoist:bidirectional" if is_bidirectional else "redoist:destination"
+        source_digest = replica.item_digest(source_item)
+        if source_digest == synced_digests.get(source_id):
+            # the synced fields are as we last wrote or propagated them, this
+            # is the echo of our own write
+            webhook_queue.count("echoes")
+        else:
+            true_target_labels = sorted(
+                [
+                    label
+                    for label in orig_target_dict["labels"]
+                    if "redoist:" not in label
+                ]
             )
-            complete_target_labels.append(target_redoist_label)
-            new_target_kwargs["labels"] = complete_target_labels
-        if source_item.get("due") != orig_target_dict.get("due"):
-            # change in due object, check for datetime then use date
-            if source_item.get("due"):
-                if source_item["due"].get("datetime"):
-                    new_target_kwargs["due_datetime"] = source_item["due"]["datetime"]
-                else:
-                    new_target_kwargs["due_string"] = source_item["due"]["date"]
-            else:
-                new_target_kwargs["due_string"] = None
-        if new_target_kwargs:
-            api.update_task(target_id, **new_target_kwargs)
+            new_target_kwargs = {}
+            for kw in [
+                "content",
+                "description",
+                "priority",
+            ]:
+                if source_item.get(kw) != orig_target_dict.get(kw):
+                    new_target_kwargs[kw] = source_item.get(kw)
+            if true_source_labels != true_target_labels:
+                # change in true labels, trigger task update
+                complete_target_labels = true_source_labels.copy()
+                target_redoist_label = (
+                    "redoist:bidirectional"
+                    if is_bidirectional
+                    else "redoist:destination"
+                )
+                complete_target_labels.append(target_redoist_label)
+                new_target_kwargs["labels"] = complete_target_labels
+            if source_item.get("due") != orig_target_dict.get("due"):
+                # the sync api takes the due object as is, null clears it
+                new_target_kwargs["due"] = source_item.get("due")
+            command_uuid = None
+            if new_target_kwargs:
+                command_uuid = batch.item_update(target_id, **new_target_kwargs)
+            # both tasks now carry the source's synced fields, the target's
+            # resulting webhook is recognized by its digest
+            new_synced_digests[source_id] = (command_uuid, source_digest)
+            if is_bidirectional:
+                new_synced_digests[target_id] = (command_uuid, source_digest)
+        if source_item.get("parent_id") != orig_target_dict.get("parent_id"):
+            # item_update cannot re-parent, follow the source parent's link
+            if source_item.get("parent_id"):
+                target_parent_id = links.get(source_item["parent_id"])
+                if target_parent_id and target_parent_id != orig_target_dict.get(
+                    "parent_id"
+                ):
+                    batch.item_move(target_id, parent_id=target_parent_id)
+            elif orig_target_dict.get("parent_id"):
+                batch.item_move(target_id, project_id=orig_target_dict["project_id"])
 
         # does the source item need its redoist label?
         correct_source_redoist_label = (
@@ -659,104 +728,375 @@ def redoist_update():
         if source_needs_label_update:
             complete_source_labels = true_source_labels.copy()
             complete_source_labels.append(correct_source_redoist_label)
-            api.update_task(source_id, labels=complete_source_labels)
+            batch.item_update(source_id, labels=complete_source_labels)
 
     for source_note in sync["notes"]:
         source_item_id = source_note["item_id"]
-        manifest = db.session.scalars(
-            db.select(RedoistManifests).where(
-                RedoistManifests.source_id == source_item_id
-            )
-        ).one_or_none()
-        if manifest is None:
+        target_item_id = links.get(source_item_id)
+        if target_item_id is None:
             continue
-        mirror = db.session.scalars(
-            db.select(RedoistManifests).where(
-                RedoistManifests.source_id == manifest.target_id,
-                RedoistManifests.target_id == source_item_id,
-            )
-        ).one_or_none()
-        is_bidirectional = True if mirror is not None else False
-        note_id_map = db.session.scalars(
-            db.select(RedoistNoteIdMap).where(
-                RedoistNoteIdMap.source_id == source_note["id"]
-            )
-        ).one_or_none()
+        is_bidirectional = mirrors.get(target_item_id) == source_item_id
+        target_note_id = note_id_maps.get(source_note["id"])
 
         # note:deleted
         if source_note["is_deleted"]:
-            db.session.execute(
-                db.delete(RedoistNoteIdMap).where(
-                    RedoistNoteIdMap.source_id == source_note["id"]
-                )
-            )
+            command_uuid = None
+            if target_note_id:
+                command_uuid = batch.note_delete(target_note_id)
+            deleted_notes[source_note["id"]] = command_uuid
             if is_bidirectional:
-                db.session.execute(
-                    db.delete(RedoistNoteIdMap).where(
-                        RedoistNoteIdMap.target_id == source_note["id"]
-                    )
-                )
-            db.session.commit()
-            if note_id_map:
-                api.delete_comment(note_id_map.target_id)
+                deleted_mirror_notes[source_note["id"]] = command_uuid
             continue
 
         # note:added
-        if note_id_map is None:
-            add_note_kwargs = {
-                "task_id": manifest.target_id,
-            }
-            if source_file := source_note.get("file_attachment"):
-                add_note_kwargs["file_attachment"] = {
-                    "file_name": source_file["file_name"],
-                    "file_size": source_file["file_size"],
-                    "file_type": source_file["file_type"],
-                    "file_url": source_file["file_url"],
-                    "upload_state": source_file["upload_state"],
-                }
-            add_note = api.add_comment(source_note["content"], **add_note_kwargs)
-            note_id_map = RedoistNoteIdMap(
-                source_id=source_note["id"],
-                target_id=add_note.id,
+        source_digest = replica.note_digest(source_note)
+        file_attachment = replica.note_attachment(source_note)
+        if target_note_id is None:
+            temp_id = batch.note_add(
+                target_item_id,
+                source_note["content"],
+                file_attachment=file_attachment,
+            )
+            added_notes.append(
+                (source_note["id"], temp_id, is_bidirectional, source_digest)
             )
-            db.session.add(note_id_map)
-            if is_bidirectional:
-                mirror_note_id_map = RedoistNoteIdMap(
-                    source_id=add_note.id,
-                    target_id=source_note["id"],
-                )
-                db.session.add(mirror_note_id_map)
-            db.session.commit()
             continue
 
-        # note:updated
-        if note_id_map:
-            target_note_id = note_id_map.target_id
-            new_note_kwargs = {}
-            orig_target_note = api.get_comment(target_note_id)
-            if source_note["content"] != orig_target_note.content:
-                new_note_kwargs["content"] = source_note["content"]
-            if (
-                source_file_attachment := source_note.get("file_attachment")
-                != orig_target_note.attachment
-            ):
-                file_attachment = {
-                    "file_name": source_file_attachment["file_name"],
-                    "file_size": source_file_attachment["file_size"],
-                    "file_type": source_file_attachment["file_type"],
-                    "file_url": source_file_attachment["file_url"],
-                    "upload_state": source_file_attachment["upload_state"],
+        # note:updated, only sent when the source differs from what was last
+        # propagated, the target itself is never read
+        if source_digest == note_digests.get(source_note["id"]):
+            continue
+        new_note_kwargs = {"content": source_note["content"]}
+        if file_attachment is not None:
+            new_note_kwargs["file_attachment"] = file_attachment
+        command_uuid = batch.note_update(target_note_id, **new_note_kwargs)
+        new_note_digests[source_note["id"]] = (command_uuid, source_digest)
+        if is_bidirectional:
+            new_note_digests[target_note_id] = (command_uuid, source_digest)
+
+    error = None
+    try:
+        batch.flush()
+    except Exception as e:
+        # commands flushed before the failure keep their results, the retry
+        # sends the others again
+        error = e
+    synced_digest_rows = [
+        {"b_source_id": source_id, "b_synced_digest": synced_digest}
+        for source_id, (command_uuid, synced_digest) in new_synced_digests.items()
+        if command_uuid is None or batch.ok(command_uuid)
+    ]
+    if synced_digest_rows:
+        db.session.execute(
+            db.update(RedoistManifests.__table__)
+            .where(RedoistManifests.source_id == bindparam("b_source_id"))
+            .values(synced_digest=bindparam("b_synced_digest")),
+            synced_digest_rows,
+        )
+    note_digest_rows = [
+        {"b_source_id": source_id, "b_digest": digest}
+        for source_id, (command_uuid, digest) in new_note_digests.items()
+        if batch.ok(command_uuid)
+    ]
+    if note_digest_rows:
+        db.session.execute(
+            db.update(RedoistNoteIdMap.__table__)
+            .where(RedoistNoteIdMap.source_id == bindparam("b_source_id"))
+            .values(digest=bindparam("b_digest")),
+            note_digest_rows,
+        )
+    unlinked_ids = [
+        source_id
+        for source_id, command_uuid in unlinked.items()
+        if removed(batch, command_uuid)
+    ]
+    for ids in replica.chunks(unlinked_ids):
+        db.session.execute(
+            db.delete(RedoistManifests).where(
+                or_(
+                    RedoistManifests.source_id.in_(ids),
+                    RedoistManifests.target_id.in_(ids),
+                )
+            )
+        )
+    deleted_note_ids = [
+        source_id
+        for source_id, command_uuid in deleted_notes.items()
+        if command_uuid is None or removed(batch, command_uuid)
+    ]
+    for ids in replica.chunks(deleted_note_ids):
+        db.session.execute(
+            db.delete(RedoistNoteIdMap).where(RedoistNoteIdMap.source_id.in_(ids))
+        )
+    deleted_mirror_note_ids = [
+        source_id
+        for source_id, command_uuid in deleted_mirror_notes.items()
+        if command_uuid is None or removed(batch, command_uuid)
+    ]
+    for ids in replica.chunks(deleted_mirror_note_ids):
+        db.session.execute(
+            db.delete(RedoistNoteIdMap).where(RedoistNoteIdMap.target_id.in_(ids))
+        )
+    note_id_map_rows = []
+    for source_note_id, temp_id, is_bidirectional, digest in added_notes:
+        target_note_id = batch.temp_id_mapping.get(temp_id)
+        if target_note_id is None:
+            continue
+        note_id_map_rows.append(
+            {"source_id": source_note_id, "target_id": target_note_id, "digest": digest}
+        )
+        if is_bidirectional:
+            note_id_map_rows.append(
+                {
+                    "source_id": target_note_id,
+                    "target_id": source_note_id,
+                    "digest": digest,
                 }
-                new_note_kwargs["attachment"] = file_attachment
-            if new_note_kwargs:
-                api.update_comment(target_note_id, **new_note_kwargs)
+            )
+    if note_id_map_rows:
+        db.session.execute(db.insert(RedoistNoteIdMap), note_id_map_rows)
+    if error is None and new_sync_token is not None:
+        user.sync_token = new_sync_token
+        db.session.add(user)
+    db.session.commit()
+    if error is not None:
+        raise error
 
     return ""
 
 
+# sync_status error tags of a delete or close whose object is gone already
+GONE_ERROR_TAGS = {"ITEM_NOT_FOUND", "NOTE_NOT_FOUND"}
+
+
+# whether the delete or close of an item or note left it gone
+def removed(batch, command_uuid):
+    status = batch.sync_status.get(command_uuid)
+    if isinstance(status, dict):
+        return status.get("error_tag") in GONE_ERROR_TAGS
+    return status == "ok"
+
+
+# build a sync response out of the webhooks' event_data, or None when an
+# incremental sync is needed
+def webhook_sync(user_id, payloads):
+    if os.environ.get("REDOIST_FAST_PATH", "1") != "1":
+        return None
+    sync = {"items": [], "notes": []}
+    seen = set()
+    for payload in payloads:
+        event_name = payload.get("event_name")
+        event_data = payload.get("event_data")
+        if event_name not in WEBHOOK_FAST_PATH_EVENTS or not event_data:
+            return None
+        # webhooks are not delivered in order, several events for the same
+        # object need the sync to tell which state is the latest
+        if event_data.get("id") in seen:
+            return None
+        seen.add(event_data.get("id"))
+        if event_name.startswith("note:"):
+            if event_data.get("item_id") is None:
+                return None
+            sync["notes"].append({"is_deleted": False, **event_data})
+            continue
+        if not all(field in event_data for field in replica.ITEM_FIELDS):
+            return None
+        if not event_data.get("updated_at"):
+            return None
+        item = {"is_deleted": False, **event_data}
+        if event_name == "item:completed":
+            # a recurring task moves on to its next date and stays open, only
+            # the sync tells whether it was closed for good
+            if (item.get("due") or {}).get("is_recurring"):
+                return None
+            item["checked"] = True
+        if event_name == "item:deleted":
+            item["is_deleted"] = True
+        sync["items"].append(item)
+    # a retried webhook can be older than what a later pass already applied,
+    # only the sync knows the latest state then
+    updated_at = replica.get_updated_at(user_id, (item["id"] for item in sync["items"]))
+    for item in sync["items"]:
+        if item["updated_at"] < (updated_at.get(item["id"]) or ""):
+            return None
+    # a note added before may have been updated since
+    note_id_maps, _ = load_note_id_maps(note["id"] for note in sync["notes"])
+    if note_id_maps:
+        return None
+    return sync
+
+
+# source_id -> target_id and source_id -> synced_digest of the manifests of
+# the given sources
+def load_links(source_ids):
+    links = {}
+    synced_digests = {}
+    for ids in replica.chunks(set(source_ids)):
+        for source_id, target_id, synced_digest in db.session.execute(
+            db.select(
+                RedoistManifests.source_id,
+                RedoistManifests.target_id,
+                RedoistManifests.synced_digest,
+            ).where(RedoistManifests.source_id.in_(ids))
+        ):
+            links[source_id] = target_id
+            synced_digests[source_id] = synced_digest
+    return links, synced_digests
+
+
+# source note id -> target note id and source note id -> digest of the given
+# source notes
+def load_note_id_maps(source_ids):
+    note_id_maps = {}
+    note_digests = {}
+    for ids in replica.chunks(set(source_ids)):
+        for source_id, target_id, digest in db.session.execute(
+            db.select(
+                RedoistNoteIdMap.source_id,
+                RedoistNoteIdMap.target_id,
+                RedoistNoteIdMap.digest,
+            ).where(RedoistNoteIdMap.source_id.in_(ids))
+        ):
+            note_id_maps[source_id] = target_id
+            note_digests[source_id] = digest
+    return note_id_maps, note_digests
+
+
+# ids among the given tasks that are already the source or target of a link
+def load_linked_ids(task_ids):
+    task_ids = set(task_ids)
+    linked = set()
+    for ids in replica.chunks(task_ids):
+        for source_id, target_id in db.session.execute(
+            db.select(RedoistManifests.source_id, RedoistManifests.target_id).where(
+                or_(
+                    RedoistManifests.source_id.in_(ids),
+                    RedoistManifests.target_id.in_(ids),
+                )
+            )
+        ):
+            linked.update([source_id, target_id])
+    return linked & task_ids
+
+
+# the given task and its descendants, or every task if root_id is None, with
+# parents before their children
+def task_hierarchy(tasks, root_id=None):
+    children = {}
+    for task in sorted(tasks, key=lambda task: task.order):
+        children.setdefault(task.parent_id, []).append(task)
+    task_ids = {task.id for task in tasks}
+    if root_id is None:
+        level = [
+            task
+            for parent_id, siblings in children.items()
+            if parent_id not in task_ids
+            for task in siblings
+        ]
+    else:
+        level = [task for task in tasks if task.id == root_id]
+    hierarchy = []
+    while level:
+        hierarchy.extend(level)
+        level = [child for task in level for child in children.get(task.id, [])]
+    return hierarchy
+
+
+# labels of the original and the new task for each link direction
+LINK_LABELS = {
+    "outbound": ("redoist:source", "redoist:destination"),
+    "inbound": ("redoist:destination", "redoist:source"),
+    "bidirectional": ("redoist:bidirectional", "redoist:bidirectional"),
+}
+
+
+# clone a hierarchy of tasks into the project and link each clone to its
+# original, all writes go out in as few sync requests as possible; tasks
+# which are already linked are left alone
+def link_hierarchy(api, user_id, tasks, project_id, direction):
+    orig_label, new_label = LINK_LABELS[direction]
+    linked_ids = load_linked_ids(task.id for task in tasks)
+    # parents outside the hierarchy, or skipped, keep their linked target
+    parent_links, _ = load_links(
+        task.parent_id for task in tasks if task.parent_id is not None
+    )
+    temp_ids = {}
+    # flushed at the end so the clones of the requests that went through get
+    # their manifests even if a later one fails
+    batch = api.batch(deferred=True)
+    for task in tasks:
+        if task.id in linked_ids:
+            continue
+        args = {
+            "project_id": project_id,
+            "description": task.description,
+            "child_order": task.order,
+            "labels": [*task.labels, new_label],
+            "priority": task.priority,
+        }
+        if task.due:
+            args["due"] = {
+                "date": task.due.datetime or task.due.date,
+                "string": task.due.string,
+                "is_recurring": task.due.is_recurring,
+            }
+        parent_id = temp_ids.get(task.parent_id) or parent_links.get(task.parent_id)
+        if parent_id is not None:
+            args["parent_id"] = parent_id
+        temp_ids[task.id] = batch.item_add(task.content, **args)
+        batch.item_update(task.id, labels=[*task.labels, orig_label])
+    error = None
+    try:
+        batch.flush()
+    except Exception as e:
+        # the clones that were not created are retried from scratch, their
+        # originals are not linked yet
+        error = e
+    # new task id -> the manifests linking it to its original
+    links = {}
+    for orig_id, temp_id in temp_ids.items():
+        new_id = batch.temp_id_mapping.get(temp_id)
+        if new_id is None:
+            continue
+        links[new_id] = []
+        if direction != "inbound":
+            links[new_id].append(
+                RedoistManifests(user_id=user_id, source_id=orig_id, target_id=new_id)
+            )
+        if direction != "outbound":
+            links[new_id].append(
+                RedoistManifests(user_id=user_id, source_id=new_id, target_id=orig_id)
+            )
+    db.session.add_all(
+        manifest for manifests in links.values() for manifest in manifests
+    )
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # another request linked some of the tasks meanwhile, keep the links
+        # that are still free and remove the clones of the others
+        db.session.rollback()
+        orphans = []
+        for new_id, manifests in links.items():
+            try:
+                with db.session.begin_nested():
+                    db.session.add_all(manifests)
+            except IntegrityError:
+                orphans.append(new_id)
+        db.session.commit()
+        logger.warning(f"Removing {len(orphans)} clones of tasks linked meanwhile")
+        with api.batch() as batch:
+            for new_id in orphans:
+                batch.item_delete(new_id)
+                del links[new_id]
+    logger.info(f"Created {len(links)} links for user {user_id} in {project_id}")
+    if error is not None:
+        raise error
+
+
 @app.route("/redoist/auth")
 def redoist_auth():
-    logger.debug(f"{request.method} {request.path}")
+    logger.debug("%s %s", request.method, request.path)
     # first clean up expired states
     db.session.execute(
         db.delete(OauthState).where(OauthState.expiration < int(time.time()))
@@ -775,7 +1115,7 @@ def redoist_auth():
 
 @app.route("/redoist/auth/callback")
 def redoist_auth_callback():
-    logger.debug(f"{request.method} {request.path}")
+    logger.debug("%s %s", request.method, request.path)
     # possible error responses from Todoist (https://developer.todoist.com/guides/#step-1-authorization-request)
     if err := request.args.get("error"):
         # User Rejected Authorization Request; error=access_denied
@@ -803,11 +1143,11 @@ def redoist_auth_callback():
         db.session.delete(oauth_state)
         db.session.commit()
         return "Expired state.", 400
-    t = requests.post(
+    t = todoist.session.post(
         "https://todoist.com/oauth/access_token",
         data={"client_id": client_id, "client_secret": client_secret, "code": code},
     )
-    logger.debug(f"Token exchange resulted in status code: {t.status_code}")
+    logger.debug("Token exchange resulted in status code: %s", t.status_code)
     if t.ok:
         # {
         #   "access_token": "0123456789abcdef0123456789abcdef01234567",
@@ -815,7 +1155,7 @@ def redoist_auth_callback():
         # }
         token = t.json()
         api_key = token.get("access_token")
-        api = Api(api_key)
+        api = get_api(api_key)
         # get user info
         user_info = api.sync(["user"])
         user_id = user_info.get("user").get("id") if user_info.get("user") else None
@@ -848,84 +1188,54 @@ def redoist_auth_callback():
 
 
 @app.route("/snoozer")
-def snoozer():
+def snoozer_page():
     return render_template("snoozer.html")
 
 
 @app.route("/snoozer/ui", methods=["GET", "POST"])
 def snoozer_ui():
-    logger.debug(f"{request.headers}")
-    logger.debug(json.dumps(request.json, indent=2, sort_keys=True))
+    logs.request_payload(logger, request)
     user_timezone = request.json["context"]["user"]["timezone"]
     user_tz = ZoneInfo(user_timezone)
     now = datetime.datetime.now(tz=user_tz)
     today = f"{now.year}-{now.month:02d}-{now.day:02d}"
     current_time = f"{now.hour:02d}:{now.minute:02d}"
+    params = request.json["action"].get("params", {})
+    is_project = params.get("source") == "project"
     if request.json["action"]["actionType"] == "initial":
-        card = {
-            "card": {
-                "body": [
-                    {
-                        "type": "ActionSet",
-                        "id": "dayChoice",
-                        "orientation": "vertical",
-                        "actions": [
-                            {
-                                "id": "Action.Today",
-                                "type": "Action.Submit",
-                                "title": "Today",
-                                "style": "positive",
-                                "data": "today",
-                            },
-                            {
-                                "id": "Action.Tomorrow",
-                                "type": "Action.Submit",
-                                "title": "Tomorrow",
-                                "style": "positive",
-                                "data": "tomorrow",
-                            },
-                            {
-                                "id": "Action.Weekend",
-                                "type": "Action.Submit",
-                                "title": "Next Weekend",
-                                "style": "positive",
-                                "data": "weekend",
-                            },
-                            {
-                                "id": "Action.Week",
-                                "type": "Action.Submit",
-                                "title": "Next Week",
-                                "style": "positive",
-                                "data": "week",
-                            },
-                        ],
-                    },
-                    {
-                        "id": "Input.Date",
-                        "separator": True,
-                        "spacing": "large",
-                        "type": "Input.Date",
-                        "value": today,
-                    },
-                    {
-                        "id": "Input.Time",
-                        "spacing": "large",
-                        "type": "Input.Time",
-                        "value": current_time,
-                    },
-                ],
-                "actions": [
-                    {
-                        "id": "Action.Inputs",
-                        "type": "Action.Submit",
-                        "title": "Submit",
-                        "style": "positive",
-                    },
-                ],
-            }
-        }
-        logger.debug(json.dumps(card, indent=2, sort_keys=True))
-        return card
+        sections = None
+        if is_project:
+            # snoozing a whole project can be narrowed to a section
+            user = db.session.get(SnoozerUsers, request.json["context"]["user"]["id"])
+            if user is None:
+                return {"error": "No user found."}, 400
+            _, all_sections = catalog.get_projects_and_sections(get_api(user.api_key))
+            sections = tuple(
+                (section["id"], section["name"])
+                for section in all_sections
+                if section["project_id"] == params["sourceId"]
+            )
+        failures = snoozer.failures(request.json["context"]["user"]["id"])
+        card = cards.snoozer_initial(
+            today,
+            current_time,
+            sections,
+            [(task_id, message) for _, task_id, message in failures],
+        )
+        logs.payload(logger, "snoozer card", card)
+        response = cards.response(card)
+        if failures:
+            failure_ids = [failure_id for failure_id, _, _ in failures]
+
+            # only forgotten once the card is sent, a failed request shows
+            # them again on the next open
+            @response.call_on_close
+            def forget_failures():
+                with app.app_context():
+                    snoozer.forget_failures(failure_ids)
+                    db.session.commit()
+
+        return response
 
     if request.json["action"]["actionType"] == "submit":
         user_id = request.json["context"]["user"]["id"]
@@ -935,12 +1245,13 @@ def snoozer_ui():
         if user is None:
             return {"error": "No user found."}, 400
         api_key = user.api_key
-        api = Api(api_key)
+        api = get_api(api_key)
+        inputs = request.json["action"].get("inputs", {})
         if request.json["action"]["actionId"] == "Action.Inputs":
-            input_date = request.json["action"]["inputs"].get("Input.Date")
+            input_date = inputs.get("Input.Date")
             if input_date is None:
                 input_date = today
-            input_time = request.json["action"]["inputs"].get("Input.Time")
+            input_time = inputs.get("Input.Time")
             if input_time is None:
                 input_time = current_time
             expiration = datetime.datetime.strptime(
@@ -958,8 +1269,28 @@ def snoozer_ui():
                 expiration = now + datetime.timedelta(days=7)
             else:
                 expiration = now
-        # move task and create job
+        if is_project:
+            return snooze_project(
+                api,
+                user_id,
+                params["sourceId"],
+                inputs.get("Input.Section", "all"),
+                inputs.get("Input.Label", "").strip(),
+                expiration,
+            )
         task_id = request.json["action"]["params"]["sourceId"]
+        if snoozer_submit == "async":
+            # the task's project is only known once the poller looks it up
+            configured = db.session.scalar(
+                db.select(SnoozerMap.id).where(SnoozerMap.user_id == user_id).limit(1)
+            )
+            if configured is None:
+                return {"error": "Snoozer not configured for any project."}, 400
+            snoozer.schedule_move(user_id, task_id, expiration.timestamp())
+            db.session.commit()
+            logger.debug("Task %s to be snoozed until %s", task_id, expiration)
+            return {"bridges": [{"bridgeActionType": "finished"}]}
+        # move task and create job
         task = api.get_task(task_id)
         source_project_id = task.project_id
         source_section_id = task.section_id
@@ -975,31 +1306,88 @@ def snoozer_ui():
             return {"error": "Snoozer not configured for this project."}, 400
         target_section_id = snooze_map.target_section_id
         api.move_task(task_id=task_id, section_id=target_section_id)
-        job_id = uuid.uuid4().hex
-        kwargs = {"task_id": task_id}
-        if target_section_id == "0":
-            kwargs["project_id"] = source_project_id
-        else:
-            kwargs["section_id"] = source_section_id
-        logger.debug(f"Job ID: {job_id}")
-        logger.debug(f"Job Args: {kwargs}")
-        logger.debug(f"Job Run Date: {expiration}")
-        scheduler.add_job(
-            job_id,
-            api.move_task,
-            kwargs=kwargs,
-            trigger="date",
-            next_run_time=expiration,
+        snoozer.schedule(
+            user_id,
+            task_id,
+            expiration.timestamp(),
+            project_id=source_project_id,
+            section_id=source_section_id,
         )
+        db.session.commit()
+        logger.debug("Task %s snoozed until %s", task_id, expiration)
         return {"bridges": [{"bridgeActionType": "finished"}]}
 
     return {"error": "Invalid action type."}, 400
 
 
+# snooze every task of a project, or of one of its sections or with a label,
+# with one task listing and the moves sent as sync batches
+def snooze_project(api, user_id, project_id, section_id, label, expiration):
+    snooze_map = db.session.execute(
+        db.select(SnoozerMap).where(
+            and_(
+                SnoozerMap.user_id == user_id,
+                SnoozerMap.source_project_id == project_id,
+            )
+        )
+    ).scalar_one_or_none()
+    if snooze_map is None:
+        return {"error": "Snoozer not configured for this project."}, 400
+    target_section_id = snooze_map.target_section_id
+    tasks = [
+        task
+        for task in api.get_tasks(project_id=project_id)
+        if (task.section_id or "0") != target_section_id
+        and (section_id == "all" or (task.section_id or "0") == section_id)
+        and (not label or label in task.labels)
+    ]
+    # subtasks move along with their parent
+    task_ids = {task.id for task in tasks}
+    tasks = [task for task in tasks if task.parent_id not in task_ids]
+    snoozed = snoozer.snooze_tasks(
+        api, user_id, tasks, target_section_id, expiration.timestamp()
+    )
+    logger.debug(
+        "%s of %s tasks of project %s snoozed until %s",
+        snoozed,
+        len(tasks),
+        project_id,
+        expiration,
+    )
+    bridges = [{"bridgeActionType": "finished"}]
+    if snoozed < len(tasks):
+        bridges.insert(
+            0,
+            {
+                "bridgeActionType": "display.notification",
+                "notification": {
+                    "type": "error",
+                    "text": f"Snoozed {snoozed} of {len(tasks)} tasks.",
+                },
+            },
+        )
+    return {"bridges": bridges}
+
+
+# webhook events after which a task has nothing left to wake
+SNOOZER_CANCEL_EVENTS = {"item:completed", "item:deleted"}
+
+
+@app.route("/snoozer/update", methods=["POST"])
+def snoozer_update():
+    logs.request_payload(logger, request)
+    if request.json["event_name"] in SNOOZER_CANCEL_EVENTS:
+        task_id = request.json["event_data"]["id"]
+        cancelled = snoozer.cancel(int(request.json["user_id"]), [task_id])
+        db.session.commit()
+        if cancelled:
+            logger.debug("Snooze of task %s cancelled", task_id)
+    return ""
+
+
 @app.route("/snoozer/settings", methods=["GET", "POST"])
 def snoozer_settings():
-    logger.debug(f"{request.method} {request.path}")
-    logger.debug(json.dumps(request.json, indent=2, sort_keys=True))
+    logs.request_payload(logger, request)
     user_id = request.json["context"]["user"]["id"]
     user = db.session.execute(
         db.select(SnoozerUsers).where(SnoozerUsers.id == user_id)
@@ -1043,21 +1431,20 @@ def snoozer_settings():
 
 
 def get_snoozer_settings_card(user_id, api_key, chosen_project=None):
-    api = Api(api_key)
-    projects = api.get_projects()
+    api = get_api(api_key)
+    projects, sections = catalog.get_projects_and_sections(api)
     project_map = {}
     section_map = {}
     for project in projects:
-        project_map[project.id] = project.name
-        project_map[project.name] = project.id
-        section_map[project.id] = {
+        project_map[project["id"]] = project["name"]
+        project_map[project["name"]] = project["id"]
+        section_map[project["id"]] = {
             "0": "(no section)",
             "(no section)": "0",
         }
-    sections = api.get_sections()
     for section in sections:
-        section_map[section.project_id][section.id] = section.name
-        section_map[section.project_id][section.name] = section.id
+        section_map[section["project_id"]][section["id"]] = section["name"]
+        section_map[section["project_id"]][section["name"]] = section["id"]
     card = {
         "card": {
             "body": [
@@ -1073,6 +1460,10 @@ def get_snoozer_settings_card(user_id, api_key, chosen_project=None):
         db.select(SnoozerMap).where(SnoozerMap.user_id == user_id)
     ).scalars()
     for snooze_map in snooze_maps:
+        sections_of_project = section_map.get(snooze_map.source_project_id, {})
+        if snooze_map.target_section_id not in sections_of_project:
+            # the project or the section was archived or deleted since
+            continue
         sm_el = {
             "type": "TextBlock",
             "text": f"{project_map[snooze_map.source_project_id]}: {section_map[snooze_map.source_project_id][snooze_map.target_section_id]}",
@@ -1096,7 +1487,7 @@ def get_snoozer_settings_card(user_id, api_key, chosen_project=None):
     )
     project_choices = [{"title": "", "value": "0", "disabled": True}]
     project_choices.extend(
-        [{"title": project.name, "value": project.id} for project in projects]
+        [{"title": project["name"], "value": project["id"]} for project in projects]
     )
     project_input = {
         "type": "Input.ChoiceSet",
@@ -1118,9 +1509,9 @@ def get_snoozer_settings_card(user_id, api_key, chosen_project=None):
         section_choices = [{"title": "(no section)", "value": None}]
         section_choices.extend(
             [
-                {"title": section.name, "value": section.id}
+                {"title": section["name"], "value": section["id"]}
                 for section in sections
-                if section.project_id == project_id
+                if section["project_id"] == project_id
             ]
         )
         card["card"]["actions"] = [
@@ -1148,7 +1539,7 @@ def get_snoozer_settings_card(user_id, api_key, chosen_project=None):
 
 @app.route("/snoozer/auth")
 def snoozer_auth():
-    logger.debug(f"{request.method} {request.path}")
+    logger.debug("%s %s", request.method, request.path)
     # first clean up expired states
     db.session.execute(
         db.delete(OauthState).where(OauthState.expiration < int(time.time()))
@@ -1167,7 +1558,7 @@ def snoozer_auth():
 
 @app.route("/snoozer/auth/callback")
 def snoozer_auth_callback():
-    logger.debug(f"{request.method} {request.path}")
+    logger.debug("%s %s", request.method, request.path)
     # possible error responses from Todoist (https://developer.todoist.com/guides/#step-1-authorization-request)
     if err := request.args.get("error"):
         # User Rejected Authorization Request; error=access_denied
@@ -1195,11 +1586,11 @@ def snoozer_auth_callback():
         db.session.delete(oauth_state)
         db.session.commit()
         return "Expired state.", 400
-    t = requests.post(
+    t = todoist.session.post(
         "https://todoist.com/oauth/access_token",
         data={"client_id": client_id, "client_secret": client_secret, "code": code},
     )
-    logger.debug(f"Token exchange resulted in status code: {t.status_code}")
+    logger.debug("Token exchange resulted in status code: %s", t.status_code)
     if t.ok:
         # {
         #   "access_token": "0123456789abcdef0123456789abcdef01234567",
@@ -1207,7 +1598,7 @@ def snoozer_auth_callback():
         # }
         token = t.json()
         api_key = token.get("access_token")
-        api = Api(api_key)
+        api = get_api(api_key)
         # get user info
         user_info = api.sync(["user"])
         user_id = user_info.get("user").get("id") if user_info.get("user") else None
@@ -1250,5 +1641,17 @@ def slack_events():
         return challenge, 200, {"Content-Type": "text/plain"}
 
 
+# start the webhook workers
+webhook_workers = webhook_queue.WorkerPool(
+    app,
+    process_redoist_update,
+    workers=int(os.environ.get("REDOIST_WORKERS", 2)),
+    max_attempts=int(os.environ.get("REDOIST_MAX_ATTEMPTS", 8)),
+    backoff_base=float(os.environ.get("REDOIST_BACKOFF_BASE", 2)),
+    backoff_max=float(os.environ.get("REDOIST_BACKOFF_MAX", 300)),
+)
+webhook_workers.start()
+
+
 if __name__ == "__main__":
     app.run()
@@ -0,0 +1,275 @@
+from functools import lru_cache
+import json
+
+from flask import Response
+
+
+# cards are assembled from pre-serialized json fragments, only the parts that
+# change between requests are encoded per render
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+dumps = _encoder.encode
+
+SPACER = dumps({"type": "TextBlock", "spacing": "large", "text": " "})
+LINK_SUBMIT = dumps(
+    {
+        "type": "Action.Submit",
+        "title": "Submit",
+        "style": "positive",
+        "associatedInputs": "auto",
+    }
+)
+DIRECTION_LABEL = "Change sync direction (red icon represents this task)"
+DIRECTION_TITLES = {
+    "outbound": "Outbound",
+    "inbound": "Inbound",
+    "bidirectional": "Bidirectional",
+    "unlink": "Unlink",
+}
+# the directions a link can be changed to, by the current direction as seen
+# from the task the menu was opened on
+LINK_CHANGES = {
+    "bidirectional": ["outbound", "inbound", "unlink"],
+    "outbound": ["inbound", "bidirectional", "unlink"],
+    "inbound": ["outbound", "bidirectional", "unlink"],
+}
+
+
+def response(card):
+    return Response(card, mimetype="application/json")
+
+
+def card(body, actions=None, adaptive=True):
+    fields = []
+    if adaptive:
+        fields.append('"type":"AdaptiveCard"')
+    fields.append(f'"body":[{",".join(body)}]')
+    if actions is not None:
+        fields.append(f'"actions":[{",".join(actions)}]')
+    return f'{{"card":{{{",".join(fields)}}}}}'
+
+
+def text_block(text):
+    return dumps({"type": "TextBlock", "text": text, "wrap": True})
+
+
+def _direction_choices(directions):
+    return [
+        {"title": DIRECTION_TITLES[direction], "value": direction}
+        for direction in directions
+    ]
+
+
+@lru_cache(maxsize=64)
+def _column_set(static_url, directions):
+    return dumps(
+        {
+            "type": "ColumnSet",
+            "spacing": "large",
+            "columns": [
+                {
+                    "type": "Column",
+                    "spacing": "large",
+                    "items": [
+                        {"type": "TextBlock", "text": DIRECTION_TITLES[direction]},
+                        {"type": "Image", "url": f"{static_url}/{direction}.png"},
+                    ],
+                }
+                for direction in directions
+            ],
+        }
+    )
+
+
+# card for a task that is already linked, direction is the current one as
+# seen from this task
+@lru_cache(maxsize=64)
+def redoist_linked(static_url, direction, is_owner):
+    body = [text_block("This task is already linked to another.")]
+    if not is_owner:
+        body.append(
+            text_block(
+                "You did not create the link and cannot modify it. Contact the owner to make changes."
+            )
+        )
+        return card(body)
+    directions = tuple(LINK_CHANGES[direction])
+    body.extend(
+        [
+            _column_set(static_url, directions),
+            SPACER,
+            dumps(
+                {
+                    "type": "Input.ChoiceSet",
+                    "spacing": "large",
+                    "label": DIRECTION_LABEL,
+                    "id": "inputDirection",
+                    "choices": _direction_choices(directions),
+                }
+            ),
+        ]
+    )
+    return card(body, [LINK_SUBMIT])
+
+
+# everything after the project choice of the card creating a new link
+@lru_cache(maxsize=64)
+def _redoist_new_tail(static_url, is_project):
+    tail = []
+    if not is_project:
+        tail.append(
+            dumps(
+                {
+                    "type": "Input.ChoiceSet",
+                    "label": "Link",
+                    "id": "inputScope",
+                    "value": "task",
+                    "choices": [
+                        {"title": "This task", "value": "task"},
+                        {"title": "This task and its subtasks", "value": "subtree"},
+                    ],
+                }
+            )
+        )
+    directions = ("outbound", "inbound", "bidirectional")
+    tail.extend(
+        [
+            SPACER,
+            _column_set(static_url, directions),
+            SPACER,
+            dumps(
+                {
+                    "type": "Input.ChoiceSet",
+                    "spacing": "large",
+                    "label": DIRECTION_LABEL,
+                    "id": "inputDirection",
+                    "choices": _direction_choices(directions),
+                }
+            ),
+        ]
+    )
+    return tail
+
+
+# card for a task or project that is not linked yet, project_choices are the
+# projects the linked tasks can be created in
+def redoist_new(static_url, project_choices, is_project):
+    if is_project:
+        intro = "Choose the project to create the linked tasks in. Every task of this project will be linked."
+    else:
+        intro = "Choose the project to create the linked task in."
+    body = [
+        text_block(intro),
+        dumps(
+            {
+                "type": "Input.ChoiceSet",
+                "label": "Project",
+                "id": "inputProject",
+                "choices": project_choices,
+            }
+        ),
+        *_redoist_new_tail(static_url, is_project),
+    ]
+    return card(body, [LINK_SUBMIT])
+
+
+TASK_URL = "https://todoist.com/showTask?id="
+SNOOZE_DAYS = dumps(
+    {
+        "type": "ActionSet",
+        "id": "dayChoice",
+        "orientation": "vertical",
+        "actions": [
+            {
+                "id": f"Action.{action}",
+                "type": "Action.Submit",
+                "title": title,
+                "style": "positive",
+                "data": data,
+            }
+            for action, title, data in [
+                ("Today", "Today", "today"),
+                ("Tomorrow", "Tomorrow", "tomorrow"),
+                ("Weekend", "Next Weekend", "weekend"),
+                ("Week", "Next Week", "week"),
+            ]
+        ],
+    }
+)
+SNOOZE_SUBMIT = dumps(
+    {
+        "id": "Action.Inputs",
+        "type": "Action.Submit",
+        "title": "Submit",
+        "style": "positive",
+    }
+)
+
+
+# sections are the (id, name) of the project's sections when snoozing every
+# task of a project, failures the (task_id, message) of earlier snoozes that
+# did not go through
+def snoozer_initial(today, current_time, sections=None, failures=()):
+    body = [
+        dumps(
+            {
+                "type": "TextBlock",
+                "text": f"Could not snooze [this task]({TASK_URL}{task_id}): {message}",
+                "color": "attention",
+                "wrap": True,
+            }
+        )
+        for task_id, message in failures
+    ]
+    if sections is not None:
+        body.extend(
+            [
+                text_block("Snooze every task of this project."),
+                dumps(
+                    {
+                        "type": "Input.ChoiceSet",
+                        "id": "Input.Section",
+                        "label": "Section",
+                        "value": "all",
+                        "choices": [
+                            {"title": "All sections", "value": "all"},
+                            {"title": "(no section)", "value": "0"},
+                            *[
+                                {"title": name, "value": section_id}
+                                for section_id, name in sections
+                            ],
+                        ],
+                    }
+                ),
+                dumps(
+                    {
+                        "type": "Input.Text",
+                        "id": "Input.Label",
+                        "label": "Only tasks with the label",
+                        "placeholder": "any label",
+                    }
+                ),
+            ]
+        )
+    body.extend(
+        [
+            SNOOZE_DAYS,
+            dumps(
+                {
+                    "id": "Input.Date",
+                    "separator": True,
+                    "spacing": "large",
+                    "type": "Input.Date",
+                    "value": today,
+                }
+            ),
+            dumps(
+                {
+                    "id": "Input.Time",
+                    "spacing": "large",
+                    "type": "Input.Time",
+                    "value": current_time,
+                }
+            ),
+        ]
+    )
+    return card(body, [SNOOZE_SUBMIT], adaptive=False)
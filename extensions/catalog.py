@@ -0,0 +1,88 @@
+from collections import OrderedDict
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# seconds a user's projects and sections are served without asking todoist
+TTL = float(os.environ.get("TODOIST_CATALOG_TTL", 60))
+# users whose projects and sections are kept in memory
+CACHE_SIZE = int(os.environ.get("TODOIST_CATALOG_CACHE_SIZE", 256))
+
+
+# a user's projects and sections as returned by the sync api, kept current
+# with incremental syncs once the ttl has passed
+class Catalog:
+    def __init__(self):
+        self.sync_token = "*"
+        self.projects = {}
+        self.sections = {}
+        self.refreshed = 0.0
+        self.lock = threading.Lock()
+
+    def refresh(self, api):
+        sync = api.sync('["projects", "sections"]', sync_token=self.sync_token)
+        full_sync = sync.get("full_sync", False)
+        for name, resources in [
+            ("projects", self.projects),
+            ("sections", self.sections),
+        ]:
+            if full_sync:
+                resources.clear()
+            for resource in sync.get(name, []):
+                if resource.get("is_deleted") or resource.get("is_archived"):
+                    resources.pop(resource["id"], None)
+                else:
+                    resources[resource["id"]] = resource
+        self.sync_token = sync["sync_token"]
+        self.refreshed = time.monotonic()
+        stats["refreshes"] += 1
+
+
+_catalogs = OrderedDict()
+_catalogs_lock = threading.Lock()
+stats = {
+    "hits": 0,
+    "refreshes": 0,
+    "evictions": 0,
+}
+
+
+# the user's active projects and sections as sync api dicts, in the order
+# todoist shows them
+def get_projects_and_sections(api):
+    with _catalogs_lock:
+        catalog = _catalogs.get(api._token)
+        if catalog is None:
+            catalog = _catalogs[api._token] = Catalog()
+        _catalogs.move_to_end(api._token)
+        while len(_catalogs) > CACHE_SIZE:
+            _catalogs.popitem(last=False)
+            stats["evictions"] += 1
+    with catalog.lock:
+        if time.monotonic() - catalog.refreshed < TTL:
+            stats["hits"] += 1
+        else:
+            catalog.refresh(api)
+        # copies, so callers can iterate while another request refreshes
+        projects = sorted(
+            catalog.projects.values(), key=lambda project: project["child_order"]
+        )
+        # sections stay cached with their archived project, in case it comes
+        # back, but are only listed along with it
+        sections = sorted(
+            (
+                section
+                for section in catalog.sections.values()
+                if section["project_id"] in catalog.projects
+            ),
+            key=lambda section: section["section_order"],
+        )
+    return projects, sections
+
+
+def get_projects(api):
+    return get_projects_and_sections(api)[0]
@@ -0,0 +1,66 @@
+import logging
+import os
+import socket
+import time
+import uuid
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Leases
+
+
+logger = logging.getLogger(__name__)
+
+
+class Lease:
+    def __init__(self, name, ttl=15.0):
+        self.name = name
+        self.ttl = ttl
+        self.holder = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.held = False
+
+    # take the lease if it is free or expired, or renew it if this process
+    # holds it already; returns whether this process holds it now
+    def acquire(self):
+        now = time.time()
+        renewed = db.session.execute(
+            db.update(Leases)
+            .where(
+                Leases.name == self.name,
+                (Leases.holder == self.holder) | (Leases.expires_at < now),
+            )
+            .values(holder=self.holder, expires_at=now + self.ttl)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        if not renewed:
+            try:
+                db.session.add(
+                    Leases(
+                        name=self.name, holder=self.holder, expires_at=now + self.ttl
+                    )
+                )
+                db.session.commit()
+                renewed = 1
+            except IntegrityError:
+                # held by another process
+                db.session.rollback()
+        held = bool(renewed)
+        if held != self.held:
+            logger.info(
+                f"{'Acquired' if held else 'Lost'} lease {self.name} as {self.holder}"
+            )
+        self.held = held
+        return held
+
+    def release(self):
+        if not self.held:
+            return
+        db.session.execute(
+            db.update(Leases)
+            .where(Leases.name == self.name, Leases.holder == self.holder)
+            .values(expires_at=0)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        self.held = False
@@ -0,0 +1,78 @@
+import atexit
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import os
+import queue
+import random
+
+
+LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.environ.get("LOG_FILE", "logs/app.log")
+MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", 10000000))
+BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", 3))
+# share of the debug records carrying a full request payload that get logged
+PAYLOAD_SAMPLE_RATE = float(os.environ.get("LOG_PAYLOAD_SAMPLE_RATE", 1))
+
+
+# dumps the payload only when a record is actually written, which happens in
+# the listener thread
+class Payload:
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __str__(self):
+        if isinstance(self.payload, str):
+            return self.payload
+        return json.dumps(self.payload, sort_keys=True, default=str)
+
+
+# one record per line, so the log can be grepped and parsed
+class OneLineFormatter(logging.Formatter):
+    def format(self, record):
+        return super().format(record).replace("\n", "\\n")
+
+
+# hands the record over as is, formatting it is left to the listener thread
+class DeferredQueueHandler(QueueHandler):
+    def prepare(self, record):
+        return record
+
+
+def setup():
+    os.makedirs(os.path.dirname(LOG_FILE) or ".", exist_ok=True)
+    file_handler = RotatingFileHandler(
+        LOG_FILE, maxBytes=MAX_BYTES, backupCount=BACKUP_COUNT
+    )
+    file_handler.setFormatter(
+        OneLineFormatter(
+            "%(asctime)s level=%(levelname)s logger=%(name)s "
+            "thread=%(threadName)s %(message)s"
+        )
+    )
+    records = queue.SimpleQueue()
+    listener = QueueListener(records, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    root = logging.getLogger()
+    root.setLevel(LEVEL)
+    root.addHandler(DeferredQueueHandler(records))
+    return listener
+
+
+def sampled(logger):
+    if not logger.isEnabledFor(logging.DEBUG):
+        return False
+    return PAYLOAD_SAMPLE_RATE >= 1 or random.random() < PAYLOAD_SAMPLE_RATE
+
+
+def payload(logger, message, data):
+    if sampled(logger):
+        logger.debug("%s payload=%s", message, Payload(data))
+
+
+def request_payload(logger, request):
+    if sampled(logger):
+        logger.debug(
+            "%s %s payload=%s", request.method, request.path, Payload(request.json)
+        )
@@ -0,0 +1,252 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import contextvars
+import functools
+import inspect
+import logging
+import threading
+import time
+
+from sqlalchemy import event
+
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds of the latency buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# upper bounds of the buckets of per scope call and query counts
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+# upper bounds in seconds of the scheduler lag buckets
+LAG_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # label values -> [bucket counts..., sum, count]
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    # count and sum of the observations per label values
+    def totals(self):
+        with self.lock:
+            return {
+                labels: (values[-1], values[-2])
+                for labels, values in self.series.items()
+            }
+
+    def collect(self, label_names):
+        with self.lock:
+            series = {labels: list(values) for labels, values in self.series.items()}
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, values in sorted(series.items()):
+            base = _labels(label_names, labels)
+            cumulative = 0
+            for bound, n in zip(self.buckets, values):
+                cumulative += n
+                lines.append(
+                    f"{self.name}_bucket{_labels(label_names, labels, le=bound)} "
+                    f"{cumulative}"
+                )
+            lines.append(
+                f'{self.name}_bucket{_labels(label_names, labels, le="+Inf")} '
+                f"{values[-1]}"
+            )
+            lines.append(f"{self.name}_sum{base} {values[-2]}")
+            lines.append(f"{self.name}_count{base} {values[-1]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, n=1):
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + n
+
+    def collect(self, label_names):
+        with self.lock:
+            series = dict(self.series)
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(series.items()):
+            lines.append(f"{self.name}{_labels(label_names, labels)} {value}")
+        return lines
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, **extra):
+    pairs = [*zip(names, values), *extra.items()]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+# metric -> label names, in the order they are rendered
+_metrics = []
+# name -> (help, callback returning {label values: value}, label names)
+_gauges = {}
+
+http_requests = Histogram(
+    "http_request_duration_seconds", "Latency of the flask routes."
+)
+_metrics.append((http_requests, ("route", "method")))
+todoist_calls = Histogram(
+    "todoist_call_duration_seconds", "Latency of the todoist.Api methods."
+)
+_metrics.append((todoist_calls, ("method",)))
+todoist_errors = Counter(
+    "todoist_call_errors_total", "todoist.Api calls that raised an exception."
+)
+_metrics.append((todoist_errors, ("method",)))
+db_queries = Histogram(
+    "db_query_duration_seconds", "Latency of the database statements."
+)
+_metrics.append((db_queries, ()))
+scope_db_queries = Histogram(
+    "scope_db_queries",
+    "Database statements per request or webhook pass.",
+    buckets=COUNT_BUCKETS,
+)
+_metrics.append((scope_db_queries, ("scope",)))
+scope_todoist_calls = Histogram(
+    "scope_todoist_calls",
+    "todoist.Api calls per request or webhook pass.",
+    buckets=COUNT_BUCKETS,
+)
+_metrics.append((scope_todoist_calls, ("scope",)))
+webhook_passes = Histogram(
+    "webhook_pass_duration_seconds", "Duration of the webhook passes."
+)
+_metrics.append((webhook_passes, ()))
+scheduler_lag = Histogram(
+    "scheduler_job_lag_seconds",
+    "Delay between a snooze's run time and its wake-up.",
+    buckets=LAG_BUCKETS,
+)
+_metrics.append((scheduler_lag, ()))
+webhook_latency = Histogram(
+    "webhook_latency_seconds",
+    "Delay between a webhook arriving and its pass finishing.",
+    buckets=LAG_BUCKETS,
+)
+_metrics.append((webhook_latency, ()))
+
+
+def gauge(name, help, callback, label_names=()):
+    _gauges[name] = (help, callback, label_names)
+
+
+# counts of the work done by the current request or webhook pass, shared by
+# the threads todoist.gather fans out to
+class Scope:
+    def __init__(self, name):
+        self.name = name
+        self.db_queries = 0
+        self.todoist_calls = 0
+        self.lock = threading.Lock()
+
+    def add(self, db_queries=0, todoist_calls=0):
+        with self.lock:
+            self.db_queries += db_queries
+            self.todoist_calls += todoist_calls
+
+
+current_scope = contextvars.ContextVar("metrics_scope", default=None)
+
+
+def enter(name):
+    scope = Scope(name)
+    return scope, current_scope.set(scope)
+
+
+def leave(scope, reset):
+    scope_db_queries.observe(scope.db_queries, scope.name)
+    scope_todoist_calls.observe(scope.todoist_calls, scope.name)
+    current_scope.reset(reset)
+
+
+@contextmanager
+def scope(name):
+    state = enter(name)
+    try:
+        yield state[0]
+    finally:
+        leave(*state)
+
+
+# times a todoist.Api method and counts it against the current scope
+def timed(name, method):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        except Exception:
+            todoist_errors.inc(name)
+            raise
+        finally:
+            todoist_calls.observe(time.perf_counter() - start, name)
+            scope = current_scope.get()
+            if scope is not None:
+                scope.add(todoist_calls=1)
+
+    wrapper.timed = True
+    return wrapper
+
+
+# wraps the public methods of a client class with timed
+def instrument(cls, exclude=()):
+    for name, method in inspect.getmembers(cls, inspect.isfunction):
+        if name.startswith("_") or name in exclude or getattr(method, "timed", False):
+            continue
+        setattr(cls, name, timed(name, method))
+    return cls
+
+
+def instrument_engine(engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        context._metrics_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        db_queries.observe(time.perf_counter() - context._metrics_start)
+        scope = current_scope.get()
+        if scope is not None:
+            scope.add(db_queries=1)
+
+
+def render():
+    lines = []
+    for metric, label_names in _metrics:
+        lines.extend(metric.collect(label_names))
+    for name, (help, callback, label_names) in _gauges.items():
+        try:
+            values = callback()
+        except Exception as e:
+            logger.error(f"Gauge {name} failed: {e}")
+            continue
+        lines.extend([f"# HELP {name} {help}", f"# TYPE {name} gauge"])
+        for labels, value in sorted(values.items()):
+            lines.append(f"{name}{_labels(label_names, labels)} {value}")
+    return "\n".join(lines) + "\n"
@@ -1,9 +1,13 @@
-from typing import List
+import logging
+from typing import Any, List
 
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, Index, JSON, inspect, text
+from sqlalchemy.exc import DatabaseError
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
+logger = logging.getLogger(__name__)
+
 
 class Base(DeclarativeBase):
     pass
@@ -31,14 +35,42 @@ class RedoistManifests(db.Model):
     __tablename__ = "redoist_manifests"
     id: Mapped[int] = mapped_column(primary_key=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("redoist_users.id"))
-    source_id: Mapped[str]
-    target_id: Mapped[str]
+    # a task is the source of at most one link
+    source_id: Mapped[str] = mapped_column(index=True, unique=True)
+    target_id: Mapped[str] = mapped_column(index=True)
+    # digest of the source's synced fields as of the last time they were
+    # propagated to or written from the other side of the link
+    synced_digest: Mapped[str] = mapped_column(nullable=True)
 
 
 class RedoistNoteIdMap(db.Model):
     __tablename__ = "redoist_note_id_map"
     source_id: Mapped[str] = mapped_column(primary_key=True)
-    target_id: Mapped[str]
+    target_id: Mapped[str] = mapped_column(index=True)
+    # digest of the content and attachment last propagated to the target
+    digest: Mapped[str] = mapped_column(nullable=True)
+
+
+# local copy of the redoist users' items, kept current from the sync
+# responses the webhook workers fetch anyway; keyed by user as items of shared
+# projects show up in the syncs of every collaborator
+class RedoistItems(db.Model):
+    __tablename__ = "redoist_items"
+    # rebuilt by a full sync when empty, migrate may recreate it
+    __table_args__ = {"info": {"cache": True}}
+    user_id: Mapped[int] = mapped_column(primary_key=True)
+    id: Mapped[str] = mapped_column(primary_key=True)
+    project_id: Mapped[str] = mapped_column(nullable=True)
+    section_id: Mapped[str] = mapped_column(nullable=True)
+    parent_id: Mapped[str] = mapped_column(nullable=True)
+    content: Mapped[str] = mapped_column(nullable=True)
+    description: Mapped[str] = mapped_column(nullable=True)
+    priority: Mapped[int] = mapped_column(nullable=True)
+    labels: Mapped[Any] = mapped_column(JSON, nullable=True)
+    due: Mapped[Any] = mapped_column(JSON, nullable=True)
+    checked: Mapped[bool] = mapped_column(default=False)
+    # todoist's timestamp of the item's last change, tells stale webhooks apart
+    updated_at: Mapped[str] = mapped_column(nullable=True)
 
 
 class SnoozerUsers(db.Model):
@@ -49,7 +81,183 @@ class SnoozerUsers(db.Model):
 
 class SnoozerMap(db.Model):
     __tablename__ = "snoozer_map"
+    # one snooze section per project and user
+    __table_args__ = (
+        Index(
+            "ix_snoozer_map_user_project", "user_id", "source_project_id", unique=True
+        ),
+    )
     id: Mapped[int] = mapped_column(primary_key=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("snoozer_users.id"))
     source_project_id: Mapped[str]
     target_section_id: Mapped[str]
+
+
+# a snoozed task and where it goes back to once run_at has passed, times are
+# unix timestamps
+class SnoozerSnoozes(db.Model):
+    __tablename__ = "snoozer_snoozes"
+    __table_args__ = (Index("ix_snoozer_snoozes_run_at", "run_at"),)
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("snoozer_users.id"))
+    task_id: Mapped[str] = mapped_column(index=True)
+    # the section to return to, or the project's root if there is none
+    project_id: Mapped[str] = mapped_column(nullable=True)
+    section_id: Mapped[str] = mapped_column(nullable=True)
+    run_at: Mapped[float]
+    # set while the task still has to be moved into the snooze section, run_at
+    # is then when to move it and this when it wakes
+    snooze_until: Mapped[float] = mapped_column(nullable=True)
+    # set while a poller is moving the task
+    locked_until: Mapped[float] = mapped_column(nullable=True)
+    # identifies the rows of the poller's last claim
+    claim_token: Mapped[str] = mapped_column(nullable=True)
+    attempts: Mapped[int] = mapped_column(default=0)
+    last_error: Mapped[str] = mapped_column(nullable=True)
+
+
+# snoozes the poller gave up on, shown the next time the user opens the card
+class SnoozerFailures(db.Model):
+    __tablename__ = "snoozer_failures"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("snoozer_users.id"), index=True)
+    task_id: Mapped[str]
+    message: Mapped[str]
+    created_at: Mapped[float]
+
+
+# a role only one process may hold at a time, kept by renewing expires_at
+class Leases(db.Model):
+    __tablename__ = "leases"
+    name: Mapped[str] = mapped_column(primary_key=True)
+    holder: Mapped[str]
+    expires_at: Mapped[float]
+
+
+class RedoistWebhookEvents(db.Model):
+    __tablename__ = "redoist_webhook_events"
+    __table_args__ = (
+        Index("ix_redoist_webhook_events_status_due", "status", "next_attempt_at"),
+        Index("ix_redoist_webhook_events_user_status", "user_id", "status"),
+    )
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[int]
+    payload: Mapped[str]
+    # pending -> processing -> deleted on success, or back to pending for a
+    # retry, or dead once the attempts are used up
+    status: Mapped[str] = mapped_column(default="pending")
+    attempts: Mapped[int] = mapped_column(default=0)
+    created_at: Mapped[float]
+    next_attempt_at: Mapped[float]
+    locked_until: Mapped[float] = mapped_column(nullable=True)
+    # identifies the events of the worker's last claim
+    claim_token: Mapped[str] = mapped_column(nullable=True)
+    last_error: Mapped[str] = mapped_column(nullable=True)
+
+
+# create_all only creates missing tables, bring existing ones up to date by
+# adding missing columns and indexes in place
+def migrate(engine):
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        primary_key = set(
+            inspector.get_pk_constraint(table.name)["constrained_columns"]
+        )
+        if table.info.get("cache") and primary_key != set(
+            table.primary_key.columns.keys()
+        ):
+            # primary keys cannot be altered in place, caches start over
+            _recreate(engine, table)
+            continue
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in columns:
+                continue
+            column_type = column.type.compile(dialect=engine.dialect)
+            _migrate(
+                engine,
+                f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}",
+                lambda: column.name
+                in {c["name"] for c in inspect(engine).get_columns(table.name)},
+            )
+        indexes = {index["name"]: index for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            _migrate_index(engine, table, index, indexes)
+
+
+def _migrate_index(engine, table, index, indexes):
+    def exists(name):
+        return name in {i["name"] for i in inspect(engine).get_indexes(table.name)}
+
+    column_names = ", ".join(column.name for column in index.columns)
+    existing = indexes.get(index.name)
+    if existing is not None and index.unique and not existing["unique"]:
+        # older versions fell back to a plain index under the unique index's
+        # name, drop it so the unique one is tried again
+        _migrate(
+            engine,
+            _drop_index(engine, table, index.name),
+            lambda: not exists(index.name),
+        )
+        existing = None
+    if existing is not None:
+        return
+    statement = f"INDEX {index.name} ON {table.name} ({column_names})"
+    if not index.unique:
+        _migrate(engine, f"CREATE {statement}", lambda: exists(index.name))
+        return
+    # plain index standing in for the unique one while duplicates block it
+    fallback_name = f"{index.name}_fallback"
+    try:
+        _migrate(engine, f"CREATE UNIQUE {statement}", lambda: exists(index.name))
+    except DatabaseError as e:
+        # existing duplicates, fall back to a plain index so lookups stay fast
+        # until the rows are cleaned up, the unique one is tried again on the
+        # next start
+        logger.error(f"Cannot create unique index {index.name}: {e}")
+        if fallback_name not in indexes:
+            _migrate(
+                engine,
+                f"CREATE INDEX {fallback_name} ON {table.name} ({column_names})",
+                lambda: exists(fallback_name),
+            )
+        return
+    if fallback_name in indexes:
+        _migrate(
+            engine,
+            _drop_index(engine, table, fallback_name),
+            lambda: not exists(fallback_name),
+        )
+
+
+def _drop_index(engine, table, name):
+    if engine.dialect.name == "mysql":
+        return f"DROP INDEX {name} ON {table.name}"
+    return f"DROP INDEX {name}"
+
+
+def _recreate(engine, table):
+    try:
+        table.drop(engine, checkfirst=True)
+        table.create(engine, checkfirst=True)
+    except DatabaseError:
+        # another process may have recreated it concurrently
+        primary_key = inspect(engine).get_pk_constraint(table.name)
+        if set(primary_key["constrained_columns"]) != set(
+            table.primary_key.columns.keys()
+        ):
+            raise
+    logger.info(f"Recreated {table.name}")
+
+
+def _migrate(engine, statement, is_done):
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(statement))
+    except DatabaseError:
+        # another process may have run the same migration concurrently
+        if not is_done():
+            raise
+    logger.info(statement)
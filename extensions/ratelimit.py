@@ -0,0 +1,166 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import contextvars
+import hashlib
+import logging
+import os
+import threading
+import time
+
+import requests
+
+
+logger = logging.getLogger(__name__)
+
+# todoist allows 1000 requests per user per 15 minutes
+RATE_LIMIT = int(os.environ.get("TODOIST_RATE_LIMIT", 1000))
+RATE_WINDOW = float(os.environ.get("TODOIST_RATE_WINDOW", 900))
+# share of the bucket background traffic leaves to interactive requests
+INTERACTIVE_RESERVE = float(os.environ.get("TODOIST_INTERACTIVE_RESERVE", 0.1))
+# how long a request may wait for its bucket before giving up
+MAX_WAIT = {
+    "interactive": float(os.environ.get("TODOIST_INTERACTIVE_MAX_WAIT", 2)),
+    "background": float(os.environ.get("TODOIST_BACKGROUND_MAX_WAIT", 60)),
+}
+MAX_RETRIES = int(os.environ.get("TODOIST_MAX_RETRIES", 3))
+# tokens whose buckets are kept in memory, the least recently used go first
+BUCKET_CACHE_SIZE = int(os.environ.get("TODOIST_BUCKET_CACHE_SIZE", 1024))
+
+# priority of the todoist calls made in the current context
+priority = contextvars.ContextVar("todoist_priority", default="background")
+
+
+class RateLimited(requests.RequestException):
+    pass
+
+
+@contextmanager
+def interactive():
+    reset = priority.set("interactive")
+    try:
+        yield
+    finally:
+        priority.reset(reset)
+
+
+class TokenBucket:
+    def __init__(self, capacity=RATE_LIMIT, window=RATE_WINDOW):
+        self.capacity = capacity
+        self.rate = capacity / window
+        self.reserve = capacity * INTERACTIVE_RESERVE
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.waits = 0
+        self.rate_limited = 0
+
+    def _refill(self, now):
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    # take a token, or return how long to wait before asking again
+    def take(self, priority):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            floor = 0 if priority == "interactive" else self.reserve
+            if self.tokens - 1 >= floor:
+                self.tokens -= 1
+                self.requests += 1
+                return 0
+            return (floor + 1 - self.tokens) / self.rate
+
+    def acquire(self, priority, max_wait):
+        deadline = time.monotonic() + max_wait
+        while True:
+            wait = self.take(priority)
+            if wait == 0:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            with self.lock:
+                self.waits += 1
+            time.sleep(wait)
+
+    def block(self, seconds):
+        with self.lock:
+            self.rate_limited += 1
+            self.tokens = 0
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def stats(self):
+        with self.lock:
+            self._refill(time.monotonic())
+            return {
+                "tokens": round(self.tokens, 1),
+                "blocked_for": round(max(0, self.blocked_until - time.monotonic()), 1),
+                "requests": self.requests,
+                "waits": self.waits,
+                "rate_limited": self.rate_limited,
+            }
+
+
+_buckets = OrderedDict()
+_buckets_lock = threading.Lock()
+
+
+def bucket(token):
+    with _buckets_lock:
+        token_bucket = _buckets.get(token)
+        if token_bucket is None:
+            token_bucket = _buckets[token] = TokenBucket()
+        _buckets.move_to_end(token)
+        while len(_buckets) > BUCKET_CACHE_SIZE:
+            _buckets.popitem(last=False)
+        return token_bucket
+
+
+# bucket state keyed by a short hash of the token, never the token itself
+def bucket_stats():
+    with _buckets_lock:
+        buckets = dict(_buckets)
+    return {
+        hashlib.sha1(token.encode()).hexdigest()[:8]: token_bucket.stats()
+        for token, token_bucket in buckets.items()
+    }
+
+
+def retry_after(response):
+    try:
+        return float(response.headers.get("Retry-After", 0)) or 1
+    except ValueError:
+        return 1
+
+
+# session that keeps every token within its quota and honours Retry-After
+class ThrottledSession(requests.Session):
+    def request(self, method, url, *args, **kwargs):
+        authorization = (kwargs.get("headers") or {}).get("Authorization", "")
+        if not authorization.startswith("Bearer "):
+            return super().request(method, url, *args, **kwargs)
+        token_bucket = bucket(authorization[len("Bearer ") :])
+        current_priority = priority.get()
+        max_wait = MAX_WAIT[current_priority]
+        for attempt in range(MAX_RETRIES + 1):
+            if not token_bucket.acquire(current_priority, max_wait):
+                if current_priority == "background":
+                    raise RateLimited(f"Rate limit reached for {method} {url}")
+                # interactive requests go out anyway and let todoist decide
+                logger.warning(f"Sending {method} {url} over the rate limit")
+            response = super().request(method, url, *args, **kwargs)
+            if response.status_code != 429:
+                return response
+            wait = retry_after(response)
+            token_bucket.block(wait)
+            logger.warning(f"{method} {url} rate limited, retry after {wait}s")
+            if attempt == MAX_RETRIES or wait > max_wait:
+                break
+        if current_priority == "background":
+            raise RateLimited(f"Rate limited by todoist for {method} {url}")
+        return response
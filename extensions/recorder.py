@@ -0,0 +1,151 @@
+import atexit
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# opt in by pointing RECORD_DIR at a directory, every process writes its own
+# gzipped json lines file there
+RECORD_DIR = os.environ.get("RECORD_DIR")
+# incoming requests worth replaying
+RECORDED_ROUTES = {
+    "/redoist/update",
+    "/redoist/ui",
+    "/snoozer/ui",
+    "/snoozer/update",
+    "/snoozer/settings",
+}
+# tokens are never written, only a short alias derived from them
+ALIAS_PREFIX = "rec-"
+# fields dropped from recorded response bodies, e.g. the token of the sync
+# api's user resource or of the oauth token exchange
+CREDENTIAL_FIELDS = {"token", "access_token", "refresh_token", "client_secret"}
+FLUSH_EVERY = 100
+
+_file = None
+_lock = threading.Lock()
+_pending = 0
+
+
+def alias(token):
+    if not token or token.startswith(ALIAS_PREFIX):
+        return token
+    return ALIAS_PREFIX + hashlib.sha1(token.encode()).hexdigest()[:16]
+
+
+def start(record_dir=RECORD_DIR):
+    global _file
+    if not record_dir:
+        return
+    os.makedirs(record_dir, exist_ok=True)
+    name = f"corpus-{os.getpid()}-{int(time.time())}.jsonl.gz"
+    path = os.path.join(record_dir, name)
+    _file = gzip.open(path, "at", encoding="utf-8")
+    atexit.register(stop)
+    logger.info(f"Recording to {path}")
+
+
+def stop():
+    global _file
+    with _lock:
+        if _file is not None:
+            _file.close()
+            _file = None
+
+
+def active():
+    return _file is not None
+
+
+def _write(record):
+    global _pending
+    line = json.dumps(record, separators=(",", ":"))
+    with _lock:
+        if _file is None:
+            return
+        _file.write(line + "\n")
+        _pending += 1
+        if _pending >= FLUSH_EVERY:
+            _file.flush()
+            _pending = 0
+
+
+def record_request(path, token, payload):
+    if _file is None or path not in RECORDED_ROUTES:
+        return
+    _write(
+        {
+            "kind": "request",
+            "at": time.time(),
+            "path": path,
+            "token": alias(token),
+            "json": payload,
+        }
+    )
+
+
+# the uuids and temp ids of sync commands, so a replay can map the recorded
+# per-command results onto the ones it sends
+def command_ids(kwargs):
+    for key in ("data", "json", "params"):
+        value = kwargs.get(key)
+        if isinstance(value, str):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                continue
+        if not isinstance(value, dict) or "commands" not in value:
+            continue
+        commands = value["commands"]
+        if isinstance(commands, str):
+            commands = json.loads(commands)
+        return [[command.get("uuid"), command.get("temp_id")] for command in commands]
+    return None
+
+
+def _redact(value):
+    if isinstance(value, dict):
+        return {
+            key: _redact(item)
+            for key, item in value.items()
+            if key not in CREDENTIAL_FIELDS
+        }
+    if isinstance(value, list):
+        return [_redact(item) for item in value]
+    return value
+
+
+# the response body without credentials, bodies that are not json are kept
+# unless they mention one of the fields
+def redact(body):
+    try:
+        return json.dumps(_redact(json.loads(body)))
+    except ValueError:
+        if any(field in body for field in CREDENTIAL_FIELDS):
+            return ""
+        return body
+
+
+def record_todoist(method, path, token, kwargs, response):
+    if _file is None:
+        return
+    _write(
+        {
+            "kind": "todoist",
+            "at": time.time(),
+            "method": method,
+            "path": path,
+            "token": alias(token),
+            "commands": command_ids(kwargs),
+            "status": response.status_code,
+            "retry_after": response.headers.get("Retry-After"),
+            "elapsed": response.elapsed.total_seconds(),
+            "body": redact(response.text),
+        }
+    )
@@ -0,0 +1,171 @@
+import hashlib
+import json
+from functools import partial
+import logging
+
+import requests
+
+from models import db, RedoistItems
+from todoist import gather
+
+
+logger = logging.getLogger(__name__)
+
+ITEM_FIELDS = [
+    "id",
+    "project_id",
+    "section_id",
+    "parent_id",
+    "content",
+    "description",
+    "priority",
+    "labels",
+    "due",
+    "checked",
+]
+# sqlite caps the number of bound parameters per statement
+CHUNK_SIZE = 500
+
+
+def chunks(values, size=CHUNK_SIZE):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i : i + size]
+
+
+# digest of the fields redoist copies between linked tasks, the redoist labels
+# and the parent are not part of it as they differ between the two sides
+def item_digest(item):
+    due = item.get("due") or {}
+    synced = [
+        item.get("content"),
+        item.get("description"),
+        item.get("priority"),
+        sorted(label for label in item.get("labels") or [] if "redoist:" not in label),
+        [due.get("date"), due.get("timezone"), due.get("is_recurring")],
+    ]
+    return hashlib.sha1(json.dumps(synced).encode()).hexdigest()
+
+
+# the attachment fields redoist copies to the target note
+def note_attachment(note):
+    source_file = note.get("file_attachment")
+    if not source_file:
+        return None
+    return {
+        "file_name": source_file["file_name"],
+        "file_size": source_file["file_size"],
+        "file_type": source_file["file_type"],
+        "file_url": source_file["file_url"],
+        "upload_state": source_file["upload_state"],
+    }
+
+
+def note_digest(note):
+    synced = [note.get("content"), note_attachment(note)]
+    return hashlib.sha1(json.dumps(synced).encode()).hexdigest()
+
+
+def is_ready(user_id):
+    # an empty replica means it was never built, the caller needs a full sync
+    return (
+        db.session.scalar(
+            db.select(RedoistItems.id).where(RedoistItems.user_id == user_id).limit(1)
+        )
+        is not None
+    )
+
+
+def _apply(user_id, items, full_sync):
+    if full_sync:
+        db.session.execute(
+            db.delete(RedoistItems).where(RedoistItems.user_id == user_id)
+        )
+    deleted_ids = [item["id"] for item in items if item.get("is_deleted")]
+    rows = {
+        item["id"]: {
+            "user_id": user_id,
+            "updated_at": item.get("updated_at"),
+            **{field: item.get(field) for field in ITEM_FIELDS},
+        }
+        for item in items
+        if not item.get("is_deleted")
+    }
+    for ids in chunks(deleted_ids):
+        db.session.execute(
+            db.delete(RedoistItems).where(
+                RedoistItems.user_id == user_id, RedoistItems.id.in_(ids)
+            )
+        )
+    existing = set()
+    if not full_sync:
+        for ids in chunks(rows):
+            existing.update(
+                db.session.scalars(
+                    db.select(RedoistItems.id).where(
+                        RedoistItems.user_id == user_id, RedoistItems.id.in_(ids)
+                    )
+                )
+            )
+    updates = [row for row_id, row in rows.items() if row_id in existing]
+    inserts = [row for row_id, row in rows.items() if row_id not in existing]
+    if updates:
+        db.session.execute(db.update(RedoistItems), updates)
+    if inserts:
+        db.session.execute(db.insert(RedoistItems), inserts)
+
+
+def apply_sync(user_id, sync):
+    if "items" in sync:
+        _apply(user_id, sync["items"], sync.get("full_sync", False))
+    db.session.commit()
+
+
+def get_items(user_id, ids):
+    items = {}
+    for chunk in chunks(set(ids)):
+        for item in db.session.scalars(
+            db.select(RedoistItems).where(
+                RedoistItems.user_id == user_id, RedoistItems.id.in_(chunk)
+            )
+        ):
+            items[item.id] = {field: getattr(item, field) for field in ITEM_FIELDS}
+    return items
+
+
+# item id -> updated_at of the given items the user's replica has
+def get_updated_at(user_id, ids):
+    updated_at = {}
+    for chunk in chunks(set(ids)):
+        updated_at.update(
+            db.session.execute(
+                db.select(RedoistItems.id, RedoistItems.updated_at).where(
+                    RedoistItems.user_id == user_id, RedoistItems.id.in_(chunk)
+                )
+            ).all()
+        )
+    return updated_at
+
+
+def _get_item(api, item_id):
+    try:
+        return api.get_item(item_id)
+    except requests.HTTPError as e:
+        logger.error(f"Failed to fetch item {item_id}: {e}")
+        return None
+
+
+# fallback for items missing from the replica, e.g. closed before it was
+# built; fetched concurrently and stored
+def fetch_items(api, user_id, item_ids):
+    item_ids = sorted(set(item_ids))
+    if not item_ids:
+        return {}
+    logger.warning(f"Items {item_ids} missing from replica of user {user_id}")
+    items = gather(*[partial(_get_item, api, item_id) for item_id in item_ids])
+    items = [item for item in items if item is not None]
+    _apply(user_id, items, False)
+    db.session.commit()
+    return {
+        item["id"]: {field: item.get(field) for field in ITEM_FIELDS} for item in items
+    }
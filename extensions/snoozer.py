@@ -0,0 +1,433 @@
+import logging
+import random
+import threading
+import time
+import traceback
+import uuid
+
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from sqlalchemy import and_, inspect, or_
+
+import metrics
+from models import db, SnoozerFailures, SnoozerMap, SnoozerSnoozes, SnoozerUsers
+from todoist import get_api
+
+
+logger = logging.getLogger(__name__)
+
+# sync_status error tags of a move whose task was deleted
+GONE_TAGS = {"ITEM_NOT_FOUND"}
+# claim lease of a leader's poller in leader ttls
+LEADER_LEASE_FACTOR = 3
+
+
+def schedule(
+    user_id, task_id, run_at, project_id=None, section_id=None, snooze_until=None
+):
+    # the caller commits
+    snooze = SnoozerSnoozes(
+        user_id=user_id,
+        task_id=task_id,
+        project_id=project_id,
+        section_id=section_id,
+        run_at=run_at,
+        snooze_until=snooze_until,
+        attempts=0,
+    )
+    db.session.add(snooze)
+    return snooze
+
+
+# record a snooze the poller moves into the snooze section right away, the
+# caller commits
+def schedule_move(user_id, task_id, snooze_until):
+    return schedule(user_id, task_id, time.time(), snooze_until=snooze_until)
+
+
+# the item_move arguments putting a task into a section, "0" being the root of
+# the project
+def move_target(project_id, section_id):
+    if section_id and section_id != "0":
+        return {"section_id": section_id}
+    return {"project_id": project_id}
+
+
+# drop the pending snoozes of tasks that were completed or deleted, rows a
+# poller holds are left to it, the caller commits
+def cancel(user_id, task_ids):
+    now = time.time()
+    result = db.session.execute(
+        db.delete(SnoozerSnoozes)
+        .where(
+            SnoozerSnoozes.user_id == user_id,
+            SnoozerSnoozes.task_id.in_(task_ids),
+            or_(
+                SnoozerSnoozes.locked_until.is_(None),
+                SnoozerSnoozes.locked_until <= now,
+            ),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount
+
+
+def report_failure(user_id, task_id, message):
+    db.session.add(
+        SnoozerFailures(
+            user_id=user_id,
+            task_id=task_id,
+            message=message,
+            created_at=time.time(),
+        )
+    )
+
+
+# the (id, task_id, message) of the user's failed snoozes, oldest first
+def failures(user_id):
+    return db.session.execute(
+        db.select(
+            SnoozerFailures.id, SnoozerFailures.task_id, SnoozerFailures.message
+        )
+        .where(SnoozerFailures.user_id == user_id)
+        .order_by(SnoozerFailures.created_at)
+    ).all()
+
+
+# drop failures the user has been shown, the caller commits
+def forget_failures(failure_ids):
+    db.session.execute(
+        db.delete(SnoozerFailures).where(SnoozerFailures.id.in_(failure_ids))
+    )
+
+
+# move the tasks into the snooze section in as few sync requests as possible
+# and record a snooze for each task todoist moved, returns how many it moved
+def snooze_tasks(api, user_id, tasks, target_section_id, run_at):
+    command_uuids = {}
+    with api.batch() as batch:
+        for task in tasks:
+            target = move_target(task.project_id, target_section_id)
+            command_uuids[task.id] = batch.item_move(task.id, **target)
+    snoozed = 0
+    for task in tasks:
+        if batch.ok(command_uuids[task.id]):
+            schedule(
+                user_id,
+                task.id,
+                run_at,
+                project_id=task.project_id,
+                section_id=task.section_id,
+            )
+            snoozed += 1
+    db.session.commit()
+    return snoozed
+
+
+def pending():
+    return db.session.scalar(db.select(db.func.count()).select_from(SnoozerSnoozes))
+
+
+# move snoozes still held by the apscheduler job store into the snoozes table,
+# the jobs are removed first so concurrent workers never migrate one twice
+def migrate_jobs(engine_url):
+    if not inspect(db.engine).has_table("apscheduler_jobs"):
+        return 0
+    jobstore = SQLAlchemyJobStore(url=engine_url)
+    jobstore.start(None, "default")
+    users = dict(
+        db.session.execute(db.select(SnoozerUsers.api_key, SnoozerUsers.id)).all()
+    )
+    migrated = 0
+    try:
+        jobs = jobstore.get_all_jobs()
+    except Exception as e:
+        logger.error(f"Cannot load apscheduler jobs: {e}")
+        return 0
+    for job in jobs:
+        api = getattr(job.func, "__self__", None)
+        user_id = users.get(getattr(api, "_token", None))
+        try:
+            jobstore.remove_job(job.id)
+        except JobLookupError:
+            continue
+        if user_id is None:
+            logger.warning(f"Dropping job {job.id} of an unknown snoozer user")
+            continue
+        schedule(
+            user_id,
+            job.kwargs["task_id"],
+            job.next_run_time.timestamp(),
+            project_id=job.kwargs.get("project_id"),
+            section_id=job.kwargs.get("section_id"),
+        )
+        migrated += 1
+    db.session.commit()
+    jobstore.shutdown()
+    if migrated:
+        logger.info(f"Migrated {migrated} apscheduler jobs to snoozes")
+    return migrated
+
+
+class SnoozePoller:
+    def __init__(
+        self,
+        app,
+        batch_size=500,
+        poll_interval=1.0,
+        lease=None,
+        max_attempts=5,
+        backoff_base=30.0,
+        leadership=None,
+    ):
+        self.app = app
+        # a leases.Lease held by the one process whose poller runs, or None
+        # to poll from every process
+        self.leadership = leadership
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        # seconds claimed snoozes stay locked to a poller that may have died;
+        # a leader renews every few seconds, so its claims need not outlive
+        # its leadership by much
+        if lease is None:
+            lease = (
+                LEADER_LEASE_FACTOR * leadership.ttl
+                if leadership is not None
+                else 300.0
+            )
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="snooze-poller", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        if self.leadership is not None:
+            # let a standby take over right away instead of after the ttl
+            with self.app.app_context():
+                self.leadership.release()
+
+    def is_leader(self):
+        return self.leadership is None or self.leadership.held
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    # acquiring the lease again is the leader's heartbeat
+                    if self.leadership is None or self.leadership.acquire():
+                        worked = self.work_once()
+                    else:
+                        worked = False
+            except Exception:
+                logger.error(f"Snooze poller failed:\n{traceback.format_exc()}")
+                worked = False
+            if not worked:
+                self._stop.wait(self.poll_interval)
+
+    def _claimable(self, now):
+        return and_(
+            SnoozerSnoozes.run_at <= now,
+            or_(
+                SnoozerSnoozes.locked_until.is_(None),
+                SnoozerSnoozes.locked_until <= now,
+            ),
+        )
+
+    # lock a batch of due snoozes, the run_at index keeps this cheap however
+    # many snoozes are pending
+    def claim(self):
+        now = time.time()
+        ids = db.session.scalars(
+            db.select(SnoozerSnoozes.id)
+            .where(self._claimable(now))
+            .order_by(SnoozerSnoozes.run_at)
+            .limit(self.batch_size)
+        ).all()
+        if not ids:
+            return []
+        claim_token = uuid.uuid4().hex
+        db.session.execute(
+            db.update(SnoozerSnoozes)
+            .where(SnoozerSnoozes.id.in_(ids), self._claimable(now))
+            .values(locked_until=now + self.lease, claim_token=claim_token)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        # only the rows no other poller got first, matched by token as a float
+        # column may not hold locked_until exactly
+        return db.session.scalars(
+            db.select(SnoozerSnoozes).where(
+                SnoozerSnoozes.id.in_(ids),
+                SnoozerSnoozes.claim_token == claim_token,
+            )
+        ).all()
+
+    def work_once(self):
+        snoozes = self.claim()
+        if not snoozes:
+            return False
+        # the token is looked up now, not when the task was snoozed
+        tokens = dict(
+            db.session.execute(
+                db.select(SnoozerUsers.id, SnoozerUsers.api_key).where(
+                    SnoozerUsers.id.in_({snooze.user_id for snooze in snoozes})
+                )
+            ).all()
+        )
+        now = time.time()
+        by_user = {}
+        for snooze in snoozes:
+            metrics.scheduler_lag.observe(now - snooze.run_at)
+            if snooze.user_id not in tokens:
+                logger.warning(f"Dropping snooze {snooze.id} of a removed user")
+                db.session.delete(snooze)
+                continue
+            by_user.setdefault(snooze.user_id, []).append(snooze)
+        users = list(by_user.items())
+        for i, (user_id, user_snoozes) in enumerate(users):
+            # a slow batch must not outlive the leadership, the lease is
+            # renewed before every user and the user's claim extended with it
+            if self.leadership is not None and not self.leadership.acquire():
+                # a standby took over, it can claim what is left right away
+                for _, rest in users[i:]:
+                    for snooze in rest:
+                        snooze.locked_until = None
+                break
+            locked_until = time.time() + self.lease
+            for snooze in user_snoozes:
+                snooze.locked_until = locked_until
+            db.session.commit()
+            api = get_api(tokens[user_id])
+            # split before snooze() turns the moves into regular snoozes
+            moves = [s for s in user_snoozes if s.snooze_until is not None]
+            wakes = [s for s in user_snoozes if s.snooze_until is None]
+            if moves:
+                self.snooze(api, user_id, moves)
+            if wakes:
+                self.wake(api, wakes)
+        db.session.commit()
+        return True
+
+    # send the (snooze, item_move arguments) of a user in one sync request,
+    # returns the snoozes whose move todoist accepted and those whose task is
+    # gone, the others are failed
+    def move(self, api, moves):
+        batch = api.batch()
+        command_uuids = {}
+        error = None
+        try:
+            for snooze, target in moves:
+                command_uuids[snooze.id] = batch.item_move(snooze.task_id, **target)
+            batch.flush()
+        except Exception:
+            # commands flushed before the failure keep their results
+            error = traceback.format_exc()
+        moved = []
+        gone = []
+        for snooze, _ in moves:
+            command_uuid = command_uuids.get(snooze.id)
+            status = batch.sync_status.get(command_uuid)
+            if batch.ok(command_uuid):
+                moved.append(snooze)
+            elif isinstance(status, dict) and status.get("error_tag") in GONE_TAGS:
+                gone.append(snooze)
+            elif command_uuid in batch.sync_status:
+                status = batch.sync_status[command_uuid]
+                self.fail(snooze, f"item_move of task {snooze.task_id}: {status}")
+            else:
+                self.fail(snooze, error or "no result")
+        return moved, gone
+
+    # move tasks snoozed from the card into their snooze section, remembering
+    # where they came from, with one task lookup and one sync request
+    def snooze(self, api, user_id, snoozes):
+        try:
+            tasks = {
+                task.id: task
+                for task in api.get_tasks(ids=[snooze.task_id for snooze in snoozes])
+            }
+        except Exception:
+            error = traceback.format_exc()
+            for snooze in snoozes:
+                self.fail(snooze, error)
+            return
+        snooze_sections = dict(
+            db.session.execute(
+                db.select(
+                    SnoozerMap.source_project_id, SnoozerMap.target_section_id
+                ).where(SnoozerMap.user_id == user_id)
+            ).all()
+        )
+        moves = []
+        for snooze in snoozes:
+            task = tasks.get(snooze.task_id)
+            if task is None:
+                self.give_up(snooze, "the task was completed or deleted.")
+                continue
+            if snooze.project_id is None:
+                # kept from an earlier attempt, the task may already have moved
+                snooze.project_id = task.project_id
+                snooze.section_id = task.section_id
+            if snooze.project_id not in snooze_sections:
+                self.give_up(snooze, "Snoozer is not configured for its project.")
+                continue
+            target = move_target(snooze.project_id, snooze_sections[snooze.project_id])
+            moves.append((snooze, target))
+        moved, gone = self.move(api, moves)
+        for snooze in gone:
+            self.give_up(snooze, "the task was completed or deleted.")
+        for snooze in moved:
+            snooze.run_at = snooze.snooze_until
+            snooze.snooze_until = None
+            snooze.locked_until = None
+            snooze.attempts = 0
+            snooze.last_error = None
+
+    # move all due tasks of a user back in one sync request, only the moves
+    # todoist rejected are retried
+    def wake(self, api, snoozes):
+        moves = [
+            (snooze, move_target(snooze.project_id, snooze.section_id))
+            for snooze in snoozes
+        ]
+        moved, gone = self.move(api, moves)
+        # a task completed or deleted while snoozed has nothing to wake
+        for snooze in moved + gone:
+            db.session.delete(snooze)
+
+    # drop a snooze that cannot succeed and tell the user on the next card
+    def give_up(self, snooze, reason):
+        logger.warning(f"Snooze {snooze.id} of task {snooze.task_id}: {reason}")
+        report_failure(snooze.user_id, snooze.task_id, reason)
+        db.session.delete(snooze)
+
+    def fail(self, snooze, error):
+        snooze.attempts += 1
+        snooze.last_error = error
+        snooze.locked_until = None
+        if snooze.attempts >= self.max_attempts:
+            logger.error(
+                f"Snooze {snooze.id} dropped after {snooze.attempts} attempts:\n{error}"
+            )
+            if snooze.snooze_until is not None:
+                report_failure(
+                    snooze.user_id, snooze.task_id, "Todoist did not accept the move."
+                )
+            db.session.delete(snooze)
+            return
+        delay = self.backoff_base * 2 ** (snooze.attempts - 1)
+        snooze.run_at = time.time() + delay * random.uniform(0.5, 1.0)
+        logger.warning(
+            f"Snooze {snooze.id} failed, retry {snooze.attempts} in {delay:.0f}s:\n{error}"
+        )
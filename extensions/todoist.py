@@ -1,20 +1,213 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 import json
 import logging
+import os
+import threading
 import uuid
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from todoist_api_python.api import TodoistAPI
 from todoist_api_python.endpoints import get_sync_url
 from todoist_api_python.http_requests import get, post
 from todoist_api_python.models import Task
 
+import metrics
+import recorder
+from ratelimit import ThrottledSession
+
 
 logger = logging.getLogger(__name__)
 
+# the sync api rejects requests carrying more than 100 commands
+SYNC_COMMAND_LIMIT = 100
+# connections kept alive to todoist.com
+POOL_SIZE = int(os.environ.get("TODOIST_POOL_SIZE", 20))
+# Api instances kept by get_api
+CLIENT_CACHE_SIZE = int(os.environ.get("TODOIST_CLIENT_CACHE_SIZE", 256))
+# threads issuing independent calls concurrently, see gather
+FANOUT_WORKERS = int(os.environ.get("TODOIST_FANOUT_WORKERS", 8))
+
+
+# todoist's api, and where requests to it are sent instead, e.g. the fake
+# server of the benchmarks
+TODOIST_URL = "https://api.todoist.com"
+BASE_URL = os.environ.get("TODOIST_BASE_URL", TODOIST_URL).rstrip("/")
+
+
+class TodoistSession(ThrottledSession):
+    def request(self, method, url, *args, **kwargs):
+        if not url.startswith(TODOIST_URL):
+            return super().request(method, url, *args, **kwargs)
+        path = url[len(TODOIST_URL) :]
+        response = super().request(method, BASE_URL + path, *args, **kwargs)
+        if recorder.active():
+            authorization = (kwargs.get("headers") or {}).get("Authorization", "")
+            token = authorization.removeprefix("Bearer ")
+            recorder.record_todoist(method, path, token, kwargs, response)
+        return response
+
+
+def create_session(pool_size=POOL_SIZE):
+    session = TodoistSession()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=False)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(
+        {
+            "Accept-Encoding": "gzip, deflate",
+            "Connection": "keep-alive",
+        }
+    )
+    return session
+
+
+# one connection pool shared by every client of the process, also used for the
+# oauth token exchange
+session = create_session()
+
+
+def move_args(task_id, project_id=None, section_id=None, parent_id=None):
+    if sum(x is not None for x in [project_id, section_id, parent_id]) != 1:
+        raise ValueError(
+            "Exactly one of project_id, section_id, or parent_id must be provided."
+        )
+    args = {
+        "id": task_id,
+    }
+    for target_name, target_id in [
+        ("project_id", project_id),
+        ("section_id", section_id),
+        ("parent_id", parent_id),
+    ]:
+        if target_id is not None:
+            args[target_name] = target_id
+    return args
+
+
+# queues sync api commands and sends them in as few requests as possible;
+# sync_status maps command uuids to todoist's per-command result and
+# temp_id_mapping maps temp ids to the ids of the created objects; a deferred
+# batch sends nothing before flush, so every result is known at one place
+class CommandBatch:
+    def __init__(self, api, limit=SYNC_COMMAND_LIMIT, deferred=False):
+        self._api = api
+        self._limit = limit
+        self._deferred = deferred
+        self.commands = []
+        self.sync_status = {}
+        self.temp_id_mapping = {}
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, command_type, args, temp_id=None):
+        command = {
+            "type": command_type,
+            "uuid": uuid.uuid4().hex,
+            "args": args,
+        }
+        if temp_id is not None:
+            command["temp_id"] = temp_id
+        self.commands.append(command)
+        if not self._deferred and len(self.commands) >= self._limit:
+            self.flush()
+        return command["uuid"]
+
+    def item_add(self, content, **kwargs):
+        # returns the temp id, it can be used as the parent_id of later items
+        # and is resolved via temp_id_mapping after flushing
+        temp_id = uuid.uuid4().hex
+        self.add("item_add", {"content": content, **kwargs}, temp_id=temp_id)
+        return temp_id
+
+    def item_update(self, item_id, **kwargs):
+        return self.add("item_update", {"id": item_id, **kwargs})
+
+    def item_close(self, item_id):
+        return self.add("item_close", {"id": item_id})
+
+    def item_delete(self, item_id):
+        return self.add("item_delete", {"id": item_id})
+
+    def item_move(self, item_id, project_id=None, section_id=None, parent_id=None):
+        args = move_args(item_id, project_id, section_id, parent_id)
+        return self.add("item_move", args)
+
+    def note_add(self, item_id, content, file_attachment=None):
+        # returns the temp id, resolve it via temp_id_mapping after flushing
+        args = {"item_id": item_id, "content": content}
+        if file_attachment is not None:
+            args["file_attachment"] = file_attachment
+        temp_id = uuid.uuid4().hex
+        self.add("note_add", args, temp_id=temp_id)
+        return temp_id
+
+    def note_update(self, note_id, **kwargs):
+        return self.add("note_update", {"id": note_id, **kwargs})
+
+    def note_delete(self, note_id):
+        return self.add("note_delete", {"id": note_id})
+
+    def ok(self, command_uuid):
+        return self.sync_status.get(command_uuid) == "ok"
+
+    def errors(self):
+        return {
+            command_uuid: status
+            for command_uuid, status in self.sync_status.items()
+            if status != "ok"
+        }
+
+    def flush(self):
+        while self.commands:
+            commands = self.commands[: self._limit]
+            self.commands = self.commands[self._limit :]
+            self._send(commands)
+        return self.sync_status
+
+    def _send(self, commands):
+        # temp ids created by an earlier request are unknown to todoist, swap
+        # them for the real ids before sending
+        for command in commands:
+            for key, value in command["args"].items():
+                if isinstance(value, str) and value in self.temp_id_mapping:
+                    command["args"][key] = self.temp_id_mapping[value]
+        result = self._api.commands(commands)
+        self.sync_status.update(result.get("sync_status", {}))
+        self.temp_id_mapping.update(result.get("temp_id_mapping", {}))
+        for command in commands:
+            status = self.sync_status.get(command["uuid"])
+            if status != "ok":
+                logger.error(
+                    f"Command {command['type']} {command['args']} failed: {status}"
+                )
+
+
 class Api(TodoistAPI):
-    def __init__(self, token: str) -> None:
-        super().__init__(token)
+    def __init__(self, token: str, session: requests.Session | None = None) -> None:
+        super().__init__(token, session=session)
+        if session is not None:
+            # a shared session outlives this client
+            self._finalizer.detach()
+
+    def batch(self, limit=SYNC_COMMAND_LIMIT, deferred=False) -> CommandBatch:
+        return CommandBatch(self, limit=limit, deferred=deferred)
+
+    def commands(self, commands):
+        endpoint = get_sync_url("sync")
+        logger.debug("Sending %s sync commands", len(commands))
+        return post(self._session, endpoint, self._token, data={"commands": commands})
 
     def get_sync_task(self, task_id: str) -> Task:
         endpoint = get_sync_url("items/get")
@@ -26,21 +219,18 @@ class Api(TodoistAPI):
         )
         return Task.from_dict(task["item"])
 
+    def get_item(self, item_id) -> dict:
+        endpoint = get_sync_url("items/get")
+        item = post(
+            self._session,
+            endpoint,
+            self._token,
+            data={"item_id": item_id, "all_data": False},
+        )
+        return item["item"]
+
     def move_task(self, task_id, project_id=None, section_id=None, parent_id=None):
-        if sum(x is not None for x in [project_id, section_id, parent_id]) != 1:
-            raise ValueError(
-                "Exactly one of project_id, section_id, or parent_id must be provided."
-            )
-        args = {
-            "id": task_id,
-        }
-        for target_name, target_id in [
-            ("project_id", project_id),
-            ("section_id", section_id),
-            ("parent_id", parent_id),
-        ]:
-            if target_id is not None:
-                args[target_name] = target_id
+        args = move_args(task_id, project_id, section_id, parent_id)
         endpoint = get_sync_url("sync")
         params = {
             "commands": json.dumps(
@@ -56,9 +246,7 @@ class Api(TodoistAPI):
         headers = {
             "Authorization": f"Bearer {self._token}",
         }
-        logger.debug(
-            f"Moving task {task_id} to {target_name}={target_id}"
-        )
+        logger.debug("Moving task %s with %s", task_id, args)
         return self._session.post(endpoint, headers=headers, params=params)
 
     def sync(self, resource_types, sync_token="*"):
@@ -70,3 +258,82 @@ class Api(TodoistAPI):
             "sync_token": sync_token,
         }
         return post(self._session, endpoint, self._token, data=data)
+
+
+# batch only builds a CommandBatch, its flush is timed as commands
+metrics.instrument(Api, exclude={"batch"})
+
+
+_clients = OrderedDict()
+_clients_lock = threading.Lock()
+client_stats = {
+    "hits": 0,
+    "misses": 0,
+    "evictions": 0,
+}
+
+
+# cached client for the token, all of them share the process wide session
+def get_api(token) -> Api:
+    with _clients_lock:
+        api = _clients.get(token)
+        if api is not None:
+            _clients.move_to_end(token)
+            client_stats["hits"] += 1
+            return api
+        client_stats["misses"] += 1
+        api = Api(token, session=session)
+        _clients[token] = api
+        while len(_clients) > CLIENT_CACHE_SIZE:
+            _clients.popitem(last=False)
+            client_stats["evictions"] += 1
+        return api
+
+
+def pool_stats():
+    with _clients_lock:
+        stats = dict(client_stats, clients=len(_clients))
+    stats["pool_size"] = POOL_SIZE
+    stats["connection_pools"] = sum(
+        len(adapter.poolmanager.pools) for adapter in set(session.adapters.values())
+    )
+    return stats
+
+
+_executor = ThreadPoolExecutor(
+    max_workers=FANOUT_WORKERS, thread_name_prefix="todoist-fanout"
+)
+
+
+def fanout_backlog():
+    return _executor._work_queue.qsize()
+
+
+# run independent calls concurrently and return their results in order, the
+# first exception raised by a call is re-raised; calls run in a copy of the
+# caller's context so they keep its rate limit priority, and must not touch
+# the flask request or the db session
+def gather(*calls):
+    futures = [
+        _executor.submit(contextvars.copy_context().run, call) for call in calls
+    ]
+    return [future.result() for future in futures]
+
+
+# like gather, but calls sharing a key (e.g. the task they update) run one
+# after the other in the given order
+def gather_by_key(keyed_calls):
+    groups = OrderedDict()
+    for index, (key, call) in enumerate(keyed_calls):
+        groups.setdefault(key, []).append((index, call))
+
+    def run_group(group):
+        return [(index, call()) for index, call in group]
+
+    results = [None] * len(keyed_calls)
+    for group_results in gather(
+        *[lambda group=group: run_group(group) for group in groups.values()]
+    ):
+        for index, result in group_results:
+            results[index] = result
+    return results
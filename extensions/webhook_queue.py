@@ -0,0 +1,267 @@
+import json
+import logging
+import random
+import threading
+import time
+import traceback
+import uuid
+
+from sqlalchemy import and_, exists, or_
+from sqlalchemy.orm import aliased
+
+import metrics
+from models import db, RedoistWebhookEvents
+
+
+logger = logging.getLogger(__name__)
+
+
+# counters of this process, see WorkerPool.stats
+counters = {
+    "received": 0,
+    "passes": 0,
+    "merged": 0,
+    "echoes": 0,
+    "fast_path": 0,
+    "retried": 0,
+    "dead": 0,
+}
+counters_lock = threading.Lock()
+
+
+def count(name, n=1):
+    with counters_lock:
+        counters[name] += n
+
+
+# number of queued events by status
+def depths():
+    return dict(
+        db.session.execute(
+            db.select(RedoistWebhookEvents.status, db.func.count()).group_by(
+                RedoistWebhookEvents.status
+            )
+        ).all()
+    )
+
+
+def enqueue(user_id, payload, delay=0.0):
+    # delay is the coalescing window, events of the same user arriving
+    # before it closes are processed together with this one
+    now = time.time()
+    event = RedoistWebhookEvents(
+        user_id=user_id,
+        payload=json.dumps(payload),
+        status="pending",
+        attempts=0,
+        created_at=now,
+        next_attempt_at=now + delay,
+    )
+    db.session.add(event)
+    db.session.commit()
+    count("received")
+    return event.id
+
+
+class WorkerPool:
+    def __init__(
+        self,
+        app,
+        handler,
+        workers=2,
+        max_attempts=8,
+        backoff_base=2.0,
+        backoff_max=300.0,
+        poll_interval=0.5,
+        lease=300.0,
+    ):
+        self.app = app
+        self.handler = handler
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self._threads = []
+        self._stop = threading.Event()
+        # users being processed by a thread of this process
+        self._busy_users = set()
+        self._busy_lock = threading.Lock()
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._run, name=f"webhook-worker-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    worked = self.work_once()
+            except Exception:
+                logger.error(f"Webhook worker failed:\n{traceback.format_exc()}")
+                worked = False
+            if not worked:
+                self._stop.wait(self.poll_interval)
+
+    def _claimable(self, now):
+        # pending events that are due, or processing events whose worker died,
+        # as long as no other worker holds an event for the same user
+        other = aliased(RedoistWebhookEvents)
+        user_busy = exists().where(
+            and_(
+                other.user_id == RedoistWebhookEvents.user_id,
+                other.id != RedoistWebhookEvents.id,
+                other.status == "processing",
+                other.locked_until > now,
+            )
+        )
+        return and_(
+            or_(
+                and_(
+                    RedoistWebhookEvents.status == "pending",
+                    RedoistWebhookEvents.next_attempt_at <= now,
+                ),
+                and_(
+                    RedoistWebhookEvents.status == "processing",
+                    RedoistWebhookEvents.locked_until <= now,
+                ),
+            ),
+            ~user_busy,
+        )
+
+    def claim(self):
+        now = time.time()
+        with self._busy_lock:
+            busy_users = set(self._busy_users)
+        query = db.select(RedoistWebhookEvents.id, RedoistWebhookEvents.user_id).where(
+            self._claimable(now)
+        )
+        if busy_users:
+            query = query.where(RedoistWebhookEvents.user_id.not_in(busy_users))
+        candidates = db.session.execute(
+            query.order_by(RedoistWebhookEvents.id).limit(10)
+        ).all()
+        for event_id, user_id in candidates:
+            with self._busy_lock:
+                if user_id in self._busy_users:
+                    continue
+                self._busy_users.add(user_id)
+            # the claim only succeeds if no other worker got there first
+            claim_token = uuid.uuid4().hex
+            claimed = db.session.execute(
+                db.update(RedoistWebhookEvents)
+                .where(RedoistWebhookEvents.id == event_id, self._claimable(now))
+                .values(
+                    status="processing",
+                    locked_until=now + self.lease,
+                    claim_token=claim_token,
+                )
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            db.session.commit()
+            if claimed:
+                return user_id, self.claim_user(user_id, now, claim_token)
+            with self._busy_lock:
+                self._busy_users.discard(user_id)
+        return None, []
+
+    def claim_user(self, user_id, now, claim_token):
+        # coalesce every other pending event of the user into this pass, even
+        # those still inside their window or waiting for a retry
+        db.session.execute(
+            db.update(RedoistWebhookEvents)
+            .where(
+                RedoistWebhookEvents.user_id == user_id,
+                RedoistWebhookEvents.status == "pending",
+            )
+            .values(
+                status="processing",
+                locked_until=now + self.lease,
+                claim_token=claim_token,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        # matched by token, a float column may not hold locked_until exactly
+        return db.session.scalars(
+            db.select(RedoistWebhookEvents)
+            .where(
+                RedoistWebhookEvents.user_id == user_id,
+                RedoistWebhookEvents.status == "processing",
+                RedoistWebhookEvents.claim_token == claim_token,
+            )
+            .order_by(RedoistWebhookEvents.id)
+        ).all()
+
+    def work_once(self):
+        user_id, events = self.claim()
+        if not events:
+            return False
+        event_ids = [event.id for event in events]
+        received_at = min(event.created_at for event in events)
+        start = time.perf_counter()
+        try:
+            with metrics.scope("webhook"):
+                self.handler([json.loads(event.payload) for event in events])
+        except Exception:
+            db.session.rollback()
+            error = traceback.format_exc()
+            for event_id in event_ids:
+                self.fail(event_id, error)
+        else:
+            db.session.execute(
+                db.delete(RedoistWebhookEvents).where(
+                    RedoistWebhookEvents.id.in_(event_ids)
+                )
+            )
+            db.session.commit()
+            count("passes")
+            count("merged", len(event_ids) - 1)
+            metrics.webhook_passes.observe(time.perf_counter() - start)
+            metrics.webhook_latency.observe(time.time() - received_at)
+        finally:
+            with self._busy_lock:
+                self._busy_users.discard(user_id)
+        return True
+
+    def stats(self):
+        with counters_lock:
+            stats = dict(counters)
+        stats.update(depths())
+        return stats
+
+    def fail(self, event_id, error):
+        event = db.session.get(RedoistWebhookEvents, event_id)
+        event.attempts += 1
+        event.last_error = error
+        event.locked_until = None
+        if event.attempts >= self.max_attempts:
+            event.status = "dead"
+            count("dead")
+            logger.error(
+                f"Webhook event {event.id} dead after {event.attempts} attempts:\n{error}"
+            )
+        else:
+            # exponential backoff with jitter
+            delay = min(
+                self.backoff_base * 2 ** (event.attempts - 1), self.backoff_max
+            )
+            delay *= random.uniform(0.5, 1.0)
+            event.status = "pending"
+            count("retried")
+            event.next_attempt_at = time.time() + delay
+            logger.warning(
+                f"Webhook event {event.id} failed, retry {event.attempts} in {delay:.1f}s:\n{error}"
+            )
+        db.session.commit()
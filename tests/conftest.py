@@ -0,0 +1,74 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+sys.path.insert(0, os.path.join(ROOT, "extensions"))
+
+from fake_todoist import FakeTodoist, serve  # noqa: E402
+from loadgen import load_app, seed_app  # noqa: E402
+
+WORKDIR = tempfile.mkdtemp(prefix="tool-extensions-tests-")
+# the app reads its configuration at import time; background threads stay off
+# so the tests drive the poller and the webhook passes themselves
+os.environ["LOG_FILE"] = os.path.join(WORKDIR, "app.log")
+os.environ["SNOOZER_MODE"] = "off"
+os.environ["REDOIST_WORKERS"] = "0"
+os.environ["TODOIST_CATALOG_TTL"] = "0"
+os.environ["TODOIST_MAX_RETRIES"] = "0"
+# started before any test module imports todoist, which reads its url once
+FAKE = FakeTodoist()
+SERVER, FAKE_URL = serve(FAKE)
+os.environ["TODOIST_BASE_URL"] = FAKE_URL
+
+
+@pytest.fixture(scope="session")
+def server():
+    app_module = load_app(FAKE_URL, f"sqlite:///{os.path.join(WORKDIR, 'tests.db')}", 0)
+    yield FAKE, app_module
+    SERVER.shutdown()
+
+
+@pytest.fixture
+def fake(server):
+    fake, _ = server
+    with fake.lock:
+        fake.users.clear()
+        fake.calls.clear()
+        fake.commands.clear()
+        fake.failures.clear()
+    return fake
+
+
+@pytest.fixture
+def app_module(server):
+    _, app_module = server
+    from models import db
+
+    with app_module.app.app_context():
+        for table in reversed(db.metadata.sorted_tables):
+            db.session.execute(table.delete())
+        db.session.commit()
+    return app_module
+
+
+# one user with a source project of linked tasks and a snooze section
+@pytest.fixture
+def seed(fake, app_module):
+    seed = fake.seed(1, 3)[0]
+    seed_app(app_module, [seed])
+    return seed
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def app_context(app_module):
+    with app_module.app.app_context():
+        yield
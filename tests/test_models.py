@@ -0,0 +1,53 @@
+from sqlalchemy import create_engine, inspect, text
+
+from models import Base, migrate
+
+INDEX = "ix_redoist_manifests_source_id"
+
+
+def manifests_engine(tmp_path, index=""):
+    engine = create_engine(f"sqlite:///{tmp_path / 'migrate.db'}")
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP INDEX {INDEX}"))
+        if index:
+            conn.execute(text(f"CREATE INDEX {index} ON redoist_manifests (source_id)"))
+        for target_id in ["1", "2"]:
+            conn.execute(
+                text(
+                    "INSERT INTO redoist_manifests (user_id, source_id, target_id)"
+                    f" VALUES (1, 'a', '{target_id}')"
+                )
+            )
+    return engine
+
+
+def indexes(engine):
+    return {
+        index["name"]: bool(index["unique"])
+        for index in inspect(engine).get_indexes("redoist_manifests")
+    }
+
+
+def dedupe(engine):
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM redoist_manifests WHERE target_id = '2'"))
+
+
+def test_unique_index_is_retried_once_duplicates_are_gone(tmp_path):
+    engine = manifests_engine(tmp_path)
+    migrate(engine)
+    assert INDEX not in indexes(engine)
+    assert indexes(engine)[f"{INDEX}_fallback"] is False
+    migrate(engine)
+    dedupe(engine)
+    migrate(engine)
+    assert indexes(engine)[INDEX] is True
+    assert f"{INDEX}_fallback" not in indexes(engine)
+
+
+def test_plain_index_under_the_unique_name_is_replaced(tmp_path):
+    engine = manifests_engine(tmp_path, index=INDEX)
+    dedupe(engine)
+    migrate(engine)
+    assert indexes(engine)[INDEX] is True
@@ -0,0 +1,85 @@
+from collections import OrderedDict
+import os
+
+import pytest
+
+import ratelimit
+
+
+@pytest.fixture(autouse=True)
+def buckets(monkeypatch):
+    # the seeded tokens repeat across tests, every test starts with full buckets
+    monkeypatch.setattr(ratelimit, "_buckets", OrderedDict())
+    return ratelimit._buckets
+
+
+@pytest.fixture
+def fast_bucket(seed, buckets):
+    # refills its 10 tokens in a tenth of a second
+    token_bucket = buckets[seed["token"]] = ratelimit.TokenBucket(10, 0.1)
+    return token_bucket
+
+
+def get_projects(seed):
+    return ratelimit.ThrottledSession().get(
+        f"{os.environ['TODOIST_BASE_URL']}/rest/v2/projects",
+        headers={"Authorization": f"Bearer {seed['token']}"},
+    )
+
+
+def test_background_leaves_reserve_to_interactive():
+    token_bucket = ratelimit.TokenBucket(10, 1000)
+    assert [token_bucket.take("background") for _ in range(9)] == [0] * 9
+    assert token_bucket.take("background") > 0
+    assert token_bucket.take("interactive") == 0
+    assert token_bucket.take("interactive") > 0
+
+
+def test_blocked_bucket_makes_every_caller_wait():
+    token_bucket = ratelimit.TokenBucket(10, 1000)
+    token_bucket.block(5)
+    assert token_bucket.take("interactive") > 4
+    assert not token_bucket.acquire("interactive", 0.01)
+    assert token_bucket.stats()["rate_limited"] == 1
+
+
+def test_session_retries_after_429(fake, seed, fast_bucket, monkeypatch):
+    monkeypatch.setattr(ratelimit, "MAX_RETRIES", 1)
+    monkeypatch.setattr(fake, "retry_after", 0.01)
+    fake.fail("GET /rest/v2/projects", status=429)
+    assert get_projects(seed).status_code == 200
+    assert fake.calls["GET /rest/v2/projects"] == 2
+    assert fast_bucket.stats()["rate_limited"] == 1
+
+
+def test_background_request_raises_once_retries_are_used_up(
+    fake, seed, fast_bucket, monkeypatch
+):
+    monkeypatch.setattr(ratelimit, "MAX_RETRIES", 0)
+    monkeypatch.setattr(fake, "retry_after", 0.01)
+    fake.fail("GET /rest/v2/projects", status=429)
+    with pytest.raises(ratelimit.RateLimited):
+        get_projects(seed)
+
+
+def test_interactive_request_returns_429(fake, seed, fast_bucket, monkeypatch):
+    monkeypatch.setattr(fake, "retry_after", 0.01)
+    fake.fail("GET /rest/v2/projects", status=429)
+    with ratelimit.interactive():
+        assert get_projects(seed).status_code == 429
+
+
+def test_background_request_gives_up_on_a_blocked_bucket(fake, seed, fast_bucket):
+    fast_bucket.block(120)
+    with pytest.raises(ratelimit.RateLimited):
+        get_projects(seed)
+    assert fake.calls["GET /rest/v2/projects"] == 0
+
+
+def test_least_recently_used_buckets_are_evicted(buckets, monkeypatch):
+    monkeypatch.setattr(ratelimit, "BUCKET_CACHE_SIZE", 2)
+    first = ratelimit.bucket("first")
+    ratelimit.bucket("second")
+    assert ratelimit.bucket("first") is first
+    ratelimit.bucket("third")
+    assert list(buckets) == ["first", "third"]
@@ -0,0 +1,42 @@
+import glob
+import gzip
+
+import requests
+
+import recorder
+
+
+def response(body):
+    response = requests.Response()
+    response.status_code = 200
+    response._content = body.encode()
+    return response
+
+
+def test_recording_leaves_out_tokens(tmp_path):
+    recorder.start(str(tmp_path))
+    try:
+        recorder.record_todoist(
+            "POST",
+            "/sync/v9/sync",
+            "secret-api-token",
+            {},
+            response(
+                '{"user": {"id": "1", "token": "secret-user-token"},'
+                ' "sync_token": "abc"}'
+            ),
+        )
+        recorder.record_todoist(
+            "POST",
+            "/oauth/access_token",
+            None,
+            {},
+            response('{"access_token": "secret-access-token"}'),
+        )
+    finally:
+        recorder.stop()
+    (path,) = glob.glob(str(tmp_path / "*.jsonl.gz"))
+    with gzip.open(path, "rt") as f:
+        recording = f.read()
+    assert "secret" not in recording
+    assert '\\"sync_token\\": \\"abc\\"' in recording
@@ -0,0 +1,251 @@
+import pytest
+import requests
+
+from models import db, RedoistManifests, RedoistNoteIdMap, RedoistUsers
+import replica
+
+
+def webhook_payload(seed, item):
+    return {
+        "event_name": "item:updated",
+        "user_id": str(seed["user_id"]),
+        "event_data": item,
+    }
+
+
+def sync_token(seed):
+    return db.session.get(RedoistUsers, seed["user_id"]).sync_token
+
+
+def test_failed_pass_keeps_sync_token(app_module, fake, seed, app_context, monkeypatch):
+    monkeypatch.setenv("REDOIST_FAST_PATH", "0")
+    source_id, target_id = seed["links"][0]
+    item = fake.edit_item(seed["token"], source_id, content="v2")
+    before = sync_token(seed)
+    fake.fail("POST /sync/v9/sync commands")
+    with pytest.raises(requests.HTTPError):
+        app_module.process_redoist_update([webhook_payload(seed, item)])
+    db.session.rollback()
+    assert sync_token(seed) == before
+    app_module.process_redoist_update([webhook_payload(seed, item)])
+    assert sync_token(seed) != before
+
+
+def test_retry_after_failed_flush_propagates_change(
+    app_module, fake, seed, app_context
+):
+    source_id, target_id = seed["links"][0]
+    item = fake.edit_item(seed["token"], source_id, content="v2")
+    fake.fail("POST /sync/v9/sync commands")
+    with pytest.raises(requests.HTTPError):
+        app_module.process_redoist_update([webhook_payload(seed, item)])
+    db.session.rollback()
+    app_module.process_redoist_update([webhook_payload(seed, item)])
+    items = fake.users[seed["token"]].resources["items"]
+    assert items[target_id]["content"] == "v2"
+
+
+def test_rejected_update_is_not_taken_for_an_echo(app_module, fake, seed, app_context):
+    source_id, target_id = seed["links"][0]
+    item = fake.edit_item(seed["token"], source_id, content="v1")
+    app_module.process_redoist_update([webhook_payload(seed, item)])
+    # gone without a change the sync reports, the replica still has it
+    fake.users[seed["token"]].resources["items"][target_id]["is_deleted"] = True
+    item = fake.edit_item(seed["token"], source_id, content="v2")
+    app_module.process_redoist_update([webhook_payload(seed, item)])
+    manifest = db.session.scalars(
+        db.select(RedoistManifests).where(RedoistManifests.source_id == source_id)
+    ).one()
+    assert manifest.synced_digest != replica.item_digest(item)
+
+
+def note_command(fake, seed, command_type, **args):
+    with fake.lock:
+        user = fake.users[seed["token"]]
+        result = fake.run_commands(
+            user,
+            [{"type": command_type, "uuid": "test", "temp_id": "test", "args": args}],
+        )
+        note_id = result["temp_id_mapping"].get("test", args.get("id"))
+        return dict(user.resources["notes"][note_id])
+
+
+def target_notes(fake, seed, target_id):
+    return [
+        note
+        for note in fake.users[seed["token"]].resources["notes"].values()
+        if note["item_id"] == target_id and not note["is_deleted"]
+    ]
+
+
+def note_payload(seed, event_name, note):
+    return {
+        "event_name": event_name,
+        "user_id": str(seed["user_id"]),
+        "event_data": note,
+    }
+
+
+def test_failed_note_update_is_retried(app_module, fake, seed, app_context):
+    source_id, target_id = seed["links"][0]
+    note = note_command(fake, seed, "note_add", item_id=source_id, content="v1")
+    app_module.process_redoist_update([note_payload(seed, "note:added", note)])
+    note = note_command(fake, seed, "note_update", id=note["id"], content="v2")
+    fake.fail("POST /sync/v9/sync commands")
+    with pytest.raises(requests.HTTPError):
+        app_module.process_redoist_update([note_payload(seed, "note:updated", note)])
+    db.session.rollback()
+    app_module.process_redoist_update([note_payload(seed, "note:updated", note)])
+    assert [note["content"] for note in target_notes(fake, seed, target_id)] == ["v2"]
+
+
+def test_notes_added_before_a_failed_request_are_mapped(
+    app_module, fake, seed, app_context, monkeypatch
+):
+    monkeypatch.setenv("REDOIST_FAST_PATH", "0")
+    source_id, target_id = seed["links"][0]
+    for n in range(101):
+        note_command(fake, seed, "note_add", item_id=source_id, content=f"{n}")
+    # the first request of 100 commands goes through, the second fails
+    fake.fail("POST /sync/v9/sync commands", after=1)
+    with pytest.raises(requests.HTTPError):
+        app_module.process_redoist_update([{"user_id": str(seed["user_id"])}])
+    db.session.rollback()
+    assert (
+        db.session.scalar(db.select(db.func.count(RedoistNoteIdMap.source_id))) == 100
+    )
+    app_module.process_redoist_update([{"user_id": str(seed["user_id"])}])
+    assert len(target_notes(fake, seed, target_id)) == 101
+
+
+def link_project(client, seed, target_project_id):
+    return client.post(
+        "/redoist/ui",
+        json={
+            "extensionType": "context-menu",
+            "action": {
+                "actionType": "submit",
+                "params": {"source": "project", "sourceId": seed["project_id"]},
+                "inputs": {
+                    "inputProject": target_project_id,
+                    "inputDirection": "outbound",
+                },
+            },
+            "context": {"user": {"id": seed["user_id"]}},
+        },
+        headers={"X-Todoist-Apptoken": seed["token"]},
+    )
+
+
+def add_task(fake, seed, content):
+    with fake.lock:
+        user = fake.users[seed["token"]]
+        item = fake._new_item({"project_id": seed["project_id"], "content": content})
+        fake._touch(user, "items", item)
+        return item["id"]
+
+
+def clones(fake, seed, content):
+    return [
+        item
+        for item in fake.users[seed["token"]].resources["items"].values()
+        if item["content"] == content
+        and item["project_id"] != seed["project_id"]
+        and not item["is_deleted"]
+    ]
+
+
+def test_linking_project_skips_linked_tasks(client, app_module, fake, seed):
+    task_id = add_task(fake, seed, "New")
+    target_project_id = fake.users[seed["token"]].resources["items"][
+        seed["links"][0][1]
+    ]["project_id"]
+    response = link_project(client, seed, target_project_id)
+    assert response.status_code == 200
+    assert fake.commands["item_add"] == 1
+    assert len(clones(fake, seed, "New")) == 1
+    with app_module.app.app_context():
+        manifest = db.session.scalars(
+            db.select(RedoistManifests).where(RedoistManifests.source_id == task_id)
+        ).one()
+    assert manifest.target_id == clones(fake, seed, "New")[0]["id"]
+
+
+def test_linking_tasks_linked_meanwhile_removes_clones(
+    client, app_module, fake, seed, monkeypatch
+):
+    add_task(fake, seed, "New")
+    # as if the links were created after this request looked them up
+    monkeypatch.setattr(app_module, "load_linked_ids", lambda task_ids: set())
+    target_project_id = fake.users[seed["token"]].resources["items"][
+        seed["links"][0][1]
+    ]["project_id"]
+    response = link_project(client, seed, target_project_id)
+    assert response.status_code == 200
+    assert len(clones(fake, seed, "New")) == 1
+    assert clones(fake, seed, "Task 0") == [
+        fake.users[seed["token"]].resources["items"][seed["links"][0][1]]
+    ]
+
+
+def test_retried_older_webhook_does_not_revert(app_module, fake, seed, app_context):
+    source_id, target_id = seed["links"][0]
+    old_item = fake.edit_item(seed["token"], source_id, content="v1")
+    # builds the replica
+    app_module.process_redoist_update([webhook_payload(seed, old_item)])
+    new_item = fake.edit_item(seed["token"], source_id, content="v2")
+    app_module.process_redoist_update([webhook_payload(seed, new_item)])
+    app_module.process_redoist_update([webhook_payload(seed, old_item)])
+    items = fake.users[seed["token"]].resources["items"]
+    assert items[target_id]["content"] == "v2"
+
+
+def test_replica_keeps_shared_items_per_user(app_module, app_context):
+    item = {field: None for field in replica.ITEM_FIELDS}
+    item.update(id="shared", content="first", checked=False)
+    replica.apply_sync(1, {"items": [item]})
+    replica.apply_sync(2, {"items": [{**item, "content": "second"}], "full_sync": True})
+    assert replica.get_items(1, ["shared"])["shared"]["content"] == "first"
+    assert replica.get_items(2, ["shared"])["shared"]["content"] == "second"
+    replica.apply_sync(1, {"items": [{**item, "is_deleted": True}]})
+    assert replica.get_items(1, ["shared"]) == {}
+    assert replica.get_updated_at(2, ["shared"]) == {"shared": None}
+
+
+def test_retry_after_failed_link_does_not_clone_twice(client, app_module, fake, seed):
+    for i in range(60):
+        add_task(fake, seed, "Bulk")
+    target_project_id = fake.users[seed["token"]].resources["items"][
+        seed["links"][0][1]
+    ]["project_id"]
+    # the second request of the batch fails
+    fake.fail("POST /sync/v9/sync commands", after=1)
+    assert link_project(client, seed, target_project_id).status_code == 500
+    linked = len(clones(fake, seed, "Bulk"))
+    assert 0 < linked < 60
+    with app_module.app.app_context():
+        assert db.session.scalar(db.select(db.func.count(RedoistManifests.id))) == (
+            3 + linked
+        )
+    assert link_project(client, seed, target_project_id).status_code == 200
+    assert len(clones(fake, seed, "Bulk")) == 60
+
+
+def test_completed_recurring_task_keeps_target_open(
+    app_module, fake, seed, app_context
+):
+    source_id, target_id = seed["links"][0]
+    due = {"date": "2026-01-01", "string": "every day", "is_recurring": True}
+    item = fake.edit_item(seed["token"], source_id, due=due)
+    app_module.process_redoist_update([webhook_payload(seed, item)])
+    # completing a recurring task moves it to its next date
+    item = fake.edit_item(seed["token"], source_id, due=dict(due, date="2026-01-02"))
+    app_module.process_redoist_update(
+        [dict(webhook_payload(seed, item), event_name="item:completed")]
+    )
+    target = fake.users[seed["token"]].resources["items"][target_id]
+    assert not target["checked"]
+    assert target["due"]["date"] == "2026-01-02"
+    assert db.session.scalars(
+        db.select(RedoistManifests).where(RedoistManifests.source_id == source_id)
+    ).all()
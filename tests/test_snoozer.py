@@ -0,0 +1,279 @@
+import time
+
+from models import db, SnoozerFailures, SnoozerSnoozes
+
+
+def ui_request(seed, action):
+    return {
+        "action": action,
+        "context": {"user": {"id": seed["user_id"], "timezone": "UTC"}},
+    }
+
+
+def submit(client, seed, task_id, data="today"):
+    return client.post(
+        "/snoozer/ui",
+        json=ui_request(
+            seed,
+            {
+                "actionType": "submit",
+                "actionId": "Action.Today",
+                "params": {"source": "task", "sourceId": task_id},
+                "data": data,
+                "inputs": {},
+            },
+        ),
+    )
+
+
+def snoozes(app_module):
+    with app_module.app.app_context():
+        return db.session.scalars(db.select(SnoozerSnoozes)).all()
+
+
+def test_submit_records_snooze(client, app_module, seed):
+    task_id = seed["links"][0][0]
+    response = submit(client, seed, task_id)
+    assert response.status_code == 200
+    assert response.json == {"bridges": [{"bridgeActionType": "finished"}]}
+    assert [snooze.task_id for snooze in snoozes(app_module)] == [task_id]
+
+
+def test_update_cancels_snooze_of_completed_task(client, app_module, seed):
+    task_id = seed["links"][0][0]
+    submit(client, seed, task_id)
+    response = client.post(
+        "/snoozer/update",
+        json={
+            "event_name": "item:completed",
+            "user_id": str(seed["user_id"]),
+            "event_data": {"id": task_id},
+        },
+    )
+    assert response.status_code == 200
+    assert snoozes(app_module) == []
+
+
+def test_metrics_reports_pending_snoozes(client, app_module, seed):
+    submit(client, seed, seed["links"][0][0])
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert "snoozer_pending 1" in response.get_data(as_text=True)
+
+
+def submit_project(client, seed, section="all", label=""):
+    return client.post(
+        "/snoozer/ui",
+        json=ui_request(
+            seed,
+            {
+                "actionType": "submit",
+                "actionId": "Action.Week",
+                "params": {"source": "project", "sourceId": seed["project_id"]},
+                "data": "week",
+                "inputs": {"Input.Section": section, "Input.Label": label},
+            },
+        ),
+    )
+
+
+def test_project_card_offers_sections(client, seed):
+    response = client.post(
+        "/snoozer/ui",
+        json=ui_request(
+            seed,
+            {
+                "actionType": "initial",
+                "params": {"source": "project", "sourceId": seed["project_id"]},
+            },
+        ),
+    )
+    assert response.status_code == 200
+    choices = response.json["card"]["body"][1]["choices"]
+    assert {"title": "Snoozed", "value": seed["section_id"]} in choices
+
+
+def test_project_submit_snoozes_every_task(client, app_module, fake, seed):
+    task_ids = [source_id for source_id, _ in seed["links"]]
+    response = submit_project(client, seed)
+    assert response.status_code == 200
+    assert response.json == {"bridges": [{"bridgeActionType": "finished"}]}
+    items = fake.users[seed["token"]].resources["items"]
+    assert all(
+        items[task_id]["section_id"] == seed["section_id"] for task_id in task_ids
+    )
+    assert fake.commands["item_move"] == len(task_ids)
+    assert fake.stats()["calls"]["POST /sync/v9/sync"] == 1
+    assert sorted(snooze.task_id for snooze in snoozes(app_module)) == sorted(task_ids)
+
+
+def test_project_submit_filters_by_label(client, app_module, fake, seed):
+    task_id, _ = seed["links"][1]
+    fake.edit_item(seed["token"], task_id, labels=["redoist:source", "later"])
+    response = submit_project(client, seed, label="later")
+    assert response.status_code == 200
+    assert [snooze.task_id for snooze in snoozes(app_module)] == [task_id]
+
+
+def test_project_submit_moves_subtasks_with_parent(client, app_module, fake, seed):
+    (parent_id, _), (child_id, _), _ = seed["links"]
+    fake.edit_item(seed["token"], child_id, parent_id=parent_id)
+    submit_project(client, seed)
+    task_ids = {snooze.task_id for snooze in snoozes(app_module)}
+    assert parent_id in task_ids
+    assert child_id not in task_ids
+
+
+def test_poller_moves_and_wakes_task(app_module, fake, seed, app_context):
+    task_id = seed["links"][0][0]
+    app_module.app.test_client().post(
+        "/snoozer/ui", json=ui_request(seed, {"actionType": "initial"})
+    )
+    submit(app_module.app.test_client(), seed, task_id)
+    poller = app_module.snooze_poller
+    assert poller.work_once()
+    items = fake.users[seed["token"]].resources["items"]
+    assert items[task_id]["section_id"] == seed["section_id"]
+    snooze = db.session.scalars(db.select(SnoozerSnoozes)).one()
+    assert snooze.snooze_until is None
+    snooze.run_at = time.time()
+    db.session.commit()
+    assert poller.work_once()
+    assert items[task_id]["section_id"] is None
+    assert db.session.scalars(db.select(SnoozerSnoozes)).all() == []
+
+
+def test_failed_snooze_shows_on_next_card(client, app_module, fake, seed):
+    task_id = seed["links"][0][0]
+    submit(client, seed, task_id)
+    with app_module.app.app_context():
+        fake.users[seed["token"]].resources["items"][task_id]["is_deleted"] = True
+        app_module.snooze_poller.work_once()
+    initial = ui_request(seed, {"actionType": "initial"})
+    response = client.post("/snoozer/ui", json=initial)
+    assert "the task was completed or deleted" in response.get_data(as_text=True)
+    response.close()
+    response = client.post("/snoozer/ui", json=initial)
+    assert "Could not snooze" not in response.get_data(as_text=True)
+
+
+def test_failures_stay_until_card_is_sent(client, app_module, seed):
+    task_id = seed["links"][0][0]
+    with app_module.app.app_context():
+        app_module.snoozer.report_failure(seed["user_id"], task_id, "rejected")
+        db.session.commit()
+    response = client.post(
+        "/snoozer/ui",
+        json=ui_request(seed, {"actionType": "initial"}),
+        buffered=False,
+    )
+    with app_module.app.app_context():
+        assert len(db.session.scalars(db.select(SnoozerFailures)).all()) == 1
+    response.close()
+    with app_module.app.app_context():
+        assert db.session.scalars(db.select(SnoozerFailures)).all() == []
+
+
+def webhook(client, seed, event_name, task_id):
+    return client.post(
+        "/snoozer/update",
+        json={
+            "event_name": event_name,
+            "user_id": str(seed["user_id"]),
+            "event_data": {"id": task_id},
+        },
+    )
+
+
+def test_update_cancels_only_the_tasks_snoozes(client, app_module, seed):
+    (first_id, _), (second_id, _), _ = seed["links"]
+    submit(client, seed, first_id)
+    submit(client, seed, second_id)
+    assert webhook(client, seed, "item:deleted", first_id).status_code == 200
+    assert webhook(client, seed, "item:updated", second_id).status_code == 200
+    assert [snooze.task_id for snooze in snoozes(app_module)] == [second_id]
+
+
+def test_update_leaves_claimed_snoozes_to_the_poller(client, app_module, seed):
+    task_id = seed["links"][0][0]
+    submit(client, seed, task_id)
+    with app_module.app.app_context():
+        db.session.execute(
+            db.update(SnoozerSnoozes).values(locked_until=time.time() + 60)
+        )
+        db.session.commit()
+    webhook(client, seed, "item:completed", task_id)
+    assert len(snoozes(app_module)) == 1
+
+
+def test_wake_drops_snooze_of_deleted_task(app_module, fake, seed, app_context):
+    task_id = seed["links"][0][0]
+    submit(app_module.app.test_client(), seed, task_id)
+    poller = app_module.snooze_poller
+    poller.work_once()
+    fake.users[seed["token"]].resources["items"][task_id]["is_deleted"] = True
+    db.session.execute(db.update(SnoozerSnoozes).values(run_at=time.time()))
+    db.session.commit()
+    assert poller.work_once()
+    assert db.session.scalars(db.select(SnoozerSnoozes)).all() == []
+
+
+class LostLease:
+    # held for the first user of a batch only
+    ttl = 10.0
+
+    def __init__(self):
+        self.held = True
+        self.renewals = 0
+
+    def acquire(self):
+        self.renewals += 1
+        self.held = self.renewals == 1
+        return self.held
+
+
+def test_poller_stops_when_leadership_is_lost(app_module, fake, app_context):
+    from loadgen import seed_app
+
+    seeds = fake.seed(2, 1)
+    seed_app(app_module, seeds)
+    for seed in seeds:
+        app_module.snoozer.schedule(
+            seed["user_id"],
+            seed["links"][0][0],
+            time.time() - 1,
+            project_id=seed["project_id"],
+        )
+    db.session.commit()
+    poller = app_module.snoozer.SnoozePoller(app_module.app, leadership=LostLease())
+    assert poller.work_once()
+    assert fake.commands["item_move"] == 1
+    (left,) = db.session.scalars(db.select(SnoozerSnoozes)).all()
+    assert left.locked_until is None
+
+
+def test_settings_card_leaves_out_archived_projects(
+    app_module, fake, seed, app_context
+):
+    app_module.get_snoozer_settings_card(seed["user_id"], seed["token"])
+    with fake.lock:
+        user = fake.users[seed["token"]]
+        project = dict(user.resources["projects"][seed["project_id"]])
+        fake._touch(user, "projects", dict(project, is_archived=True))
+    card = app_module.get_snoozer_settings_card(seed["user_id"], seed["token"])
+    assert seed["project_id"] not in str(card)
+
+
+def test_leader_claims_expire_with_its_leadership(app_module):
+    poller = app_module.snoozer.SnoozePoller(app_module.app, leadership=LostLease())
+    assert poller.lease == app_module.snoozer.LEADER_LEASE_FACTOR * LostLease.ttl
+    assert app_module.snoozer.SnoozePoller(app_module.app).lease == 300.0
+
+
+def test_claimed_snoozes_are_left_to_their_poller(app_module, seed, app_context):
+    submit(app_module.app.test_client(), seed, seed["links"][0][0])
+    first = app_module.snoozer.SnoozePoller(app_module.app)
+    second = app_module.snoozer.SnoozePoller(app_module.app)
+    (claimed,) = first.claim()
+    assert claimed.claim_token is not None
+    assert second.claim() == []
@@ -0,0 +1,63 @@
+import time
+
+import pytest
+
+from models import db, RedoistWebhookEvents
+import webhook_queue
+
+
+class Handler:
+    def __init__(self, error=None):
+        self.error = error
+        self.passes = []
+
+    def __call__(self, payloads):
+        self.passes.append(payloads)
+        if self.error is not None:
+            raise self.error
+
+
+def counted(name):
+    with webhook_queue.counters_lock:
+        return webhook_queue.counters[name]
+
+
+def events():
+    return db.session.scalars(
+        db.select(RedoistWebhookEvents).order_by(RedoistWebhookEvents.id)
+    ).all()
+
+
+def test_pass_merges_window_and_retry_events(app_module, app_context):
+    webhook_queue.enqueue(1, {"n": 1})
+    webhook_queue.enqueue(1, {"n": 2}, delay=60)
+    retry_id = webhook_queue.enqueue(1, {"n": 3})
+    retry = db.session.get(RedoistWebhookEvents, retry_id)
+    retry.attempts = 1
+    retry.next_attempt_at = time.time() + 60
+    db.session.commit()
+    webhook_queue.enqueue(2, {"n": 4}, delay=60)
+    handler = Handler()
+    pool = webhook_queue.WorkerPool(app_module.app, handler)
+    merged = counted("merged")
+    assert pool.work_once()
+    assert handler.passes == [[{"n": 1}, {"n": 2}, {"n": 3}]]
+    assert counted("merged") == merged + 2
+    # the other user's event still waits for its window
+    assert [event.user_id for event in events()] == [2]
+    assert not pool.work_once()
+
+
+@pytest.mark.parametrize("max_attempts, status", [(1, "dead"), (2, "pending")])
+def test_failed_pass_retries_until_dead(app_module, app_context, max_attempts, status):
+    webhook_queue.enqueue(1, {"n": 1})
+    handler = Handler(RuntimeError("boom"))
+    pool = webhook_queue.WorkerPool(app_module.app, handler, max_attempts=max_attempts)
+    dead = counted("dead")
+    assert pool.work_once()
+    (event,) = events()
+    assert event.status == status
+    assert event.attempts == 1
+    assert "boom" in event.last_error
+    assert counted("dead") == dead + (status == "dead")
+    assert webhook_queue.depths() == {status: 1}